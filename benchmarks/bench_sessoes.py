@@ -0,0 +1,200 @@
+"""Benchmark de sessões simultâneas de leitores (scanners) no streamlit_app.py.
+
+Roda o app com o AppTest do Streamlit, sem rede: o armazenamento é o backend
+"fake" do próprio app (PlanilhaSimulada, com latência e cota configuráveis) e
+o CSV de usuários é servido por um servidor HTTP local. Cada sessão percorre o
+fluxo completo:
+
+    login -> bulto -> categoria -> N leituras de SKU -> Finalizar Bulto
+
+e o relatório mostra p50/p99 de latência por etapa, reruns por etapa e
+chamadas à planilha por bulto.
+
+Uso:
+    python benchmarks/bench_sessoes.py --sessoes 8 --bultos 3 --skus 20
+"""
+import argparse
+import http.server
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from streamlit.runtime import Runtime
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "streamlit_app.py")
+CATEGORIA = "Costura"
+COLUNAS_CSV = "Usuário,Criptografia\n"
+
+# O script roda por este wrapper para contarmos cada execução (inclusive as
+# disparadas por st.rerun) no session_state da própria sessão. Ele também
+# guarda o armazenamento e o journal do app (cache_resource do runtime das
+# sessões) em ESTADO, para o relatório ler os contadores do simulador.
+WRAPPER = f"""
+import streamlit as st
+import bench_sessoes
+st.session_state["_bench_reruns"] = st.session_state.get("_bench_reruns", 0) + 1
+app = {{"__name__": "__main__", "__file__": {APP_PATH!r}}}
+try:
+    with open({APP_PATH!r}, encoding="utf-8") as f:
+        exec(compile(f.read(), {APP_PATH!r}, "exec"), app)
+finally:
+    if "armazenamento" not in bench_sessoes.ESTADO and "get_journal" in app:
+        bench_sessoes.ESTADO["armazenamento"] = app["get_armazenamento"]()
+        bench_sessoes.ESTADO["journal"] = app["get_journal"]()
+"""
+ESTADO = {}
+sys.modules.setdefault("bench_sessoes", sys.modules[__name__])
+
+
+def permitir_sessoes_paralelas():
+    # O AppTest zera Runtime._instance ao fim de cada run; com sessões em
+    # paralelo isso derruba as outras. Mantemos o último runtime criado.
+    original = Runtime.instance.__func__
+    ultimo = {}
+
+    def instance(cls):
+        if cls._instance is not None:
+            ultimo["runtime"] = cls._instance
+            return cls._instance
+        if "runtime" in ultimo:
+            return ultimo["runtime"]
+        return original(cls)
+
+    Runtime.instance = classmethod(instance)
+
+
+def escrever_secrets(csv_url, latencia, cota):
+    # Secrets em arquivo (e não via AppTest.secrets, que troca st.secrets a cada run)
+    os.makedirs(".streamlit", exist_ok=True)
+    with open(os.path.join(".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f'[storage]\nbackend = "fake"\nlatencia_min = {latencia}\nlatencia_max = {latencia}\n')
+        f.write(f'cota_por_minuto = {cota}\n\n')
+        f.write(f'[usuarios]\ncsv_url = "{csv_url}"\n')
+
+
+def linhas_de_dados(armazenamento):
+    abas = [aba for aba in armazenamento.listar_abas() if "Resumo" not in aba]
+    return sum(len(armazenamento.ler_registros(aba)[1]) for aba in abas)
+
+
+# --- CSV DE USUÁRIOS ---
+def servir_csv_usuarios(sessoes):
+    corpo = (COLUNAS_CSV + "".join(f"Operador {i},COD{i:04d}\n" for i in range(sessoes))).encode("utf-8")
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv; charset=utf-8")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://127.0.0.1:{servidor.server_address[1]}/usuarios.csv"
+
+
+# --- SESSÕES ---
+class Sessao:
+    def __init__(self, indice, timeout):
+        self.indice = indice
+        self.at = AppTest.from_string(WRAPPER, default_timeout=timeout)
+        self.latencias = defaultdict(list)
+        self.reruns = defaultdict(list)
+        self.erros = []
+
+    def _passo(self, etapa, acao):
+        antes = self.at.session_state["_bench_reruns"] if "_bench_reruns" in self.at.session_state else 0
+        inicio = time.perf_counter()
+        acao()
+        self.latencias[etapa].append(time.perf_counter() - inicio)
+        self.reruns[etapa].append(self.at.session_state["_bench_reruns"] - antes)
+        if self.at.exception:
+            self.erros.append(f"{etapa}: {self.at.exception[0].message}")
+
+    def _input_sku(self):
+        return next(t for t in self.at.text_input if t.key and t.key.startswith("sku_input"))
+
+    def executar(self, bultos, skus):
+        at = self.at
+        self._passo("abrir", at.run)
+        self._passo("iniciar", lambda: next(b for b in at.button if b.label == "Iniciar").click().run())
+        self._passo("login", lambda: at.text_input(key="user_input").input(f"cod{self.indice:04d}").run())
+        for b in range(bultos):
+            numero = f"S{self.indice:03d}-B{b:03d}"
+            self._passo("bulto", lambda: at.text_input(key="bulto_input").input(numero).run())
+            self._passo("categoria", lambda: at.button(key=f"cat_{CATEGORIA}").click().run())
+            for k in range(skus):
+                self._passo("sku", lambda: self._input_sku().input(f"789{self.indice:03d}{b:03d}{k:04d}").run())
+            self._passo("finalizar", lambda: at.button(key="finalizar_bulto").click().run())
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessoes", type=int, default=4, help="sessões (scanners) simultâneas")
+    parser.add_argument("--bultos", type=int, default=2, help="bultos por sessão")
+    parser.add_argument("--skus", type=int, default=10, help="leituras de SKU por bulto")
+    parser.add_argument("--latencia", type=float, default=0.05, help="latência (s) de cada chamada à planilha")
+    parser.add_argument("--cota", type=int, default=0, help="chamadas por minuto do simulador (0 = sem limite)")
+    parser.add_argument("--timeout", type=float, default=60.0, help="timeout (s) de cada rerun")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench-backstock-"))  # journal local isolado
+    servidor, csv_url = servir_csv_usuarios(args.sessoes)
+    escrever_secrets(csv_url, args.latencia, args.cota)
+    permitir_sessoes_paralelas()
+
+    sessoes = [Sessao(i, args.timeout) for i in range(args.sessoes)]
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=s.executar, args=(args.bultos, args.skus)) for s in sessoes]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracao = time.perf_counter() - inicio
+
+    # Espera o flusher esvaziar o journal antes de contar as chamadas à planilha
+    esperado = args.sessoes * args.bultos * args.skus
+    limite = time.time() + args.timeout
+    while "journal" in ESTADO and ESTADO["journal"].status()["pendentes"] and time.time() < limite:
+        time.sleep(0.2)
+    servidor.shutdown()
+    chamadas = dict(ESTADO["armazenamento"].simulador.contadores) if ESTADO else {}
+    linhas = linhas_de_dados(ESTADO["armazenamento"]) if ESTADO else 0
+
+    print(f"sessões={args.sessoes} bultos/sessão={args.bultos} skus/bulto={args.skus} "
+          f"latência planilha={args.latencia * 1000:.0f}ms duração={duracao:.1f}s")
+    print(f"{'etapa':<10} {'n':>6} {'p50 ms':>9} {'p99 ms':>9} {'reruns/passo':>13}")
+    for etapa in ["abrir", "iniciar", "login", "bulto", "categoria", "sku", "finalizar"]:
+        latencias = [v for s in sessoes for v in s.latencias[etapa]]
+        reruns = [v for s in sessoes for v in s.reruns[etapa]]
+        if latencias:
+            print(f"{etapa:<10} {len(latencias):>6} {percentil(latencias, 50) * 1000:>9.1f} "
+                  f"{percentil(latencias, 99) * 1000:>9.1f} {statistics.mean(reruns):>13.2f}")
+    bultos_total = args.sessoes * args.bultos
+    total_chamadas = sum(chamadas.values())
+    print(f"linhas na planilha: {linhas} de {esperado} peças lidas")
+    print(f"chamadas à planilha: {total_chamadas} ({total_chamadas / bultos_total:.2f} por bulto)")
+    for operacao, n in sorted(chamadas.items()):
+        print(f"  {operacao:<16} {n:>6} ({n / bultos_total:.2f} por bulto)")
+    erros = [e for s in sessoes for e in s.erros]
+    for erro in erros[:10]:
+        print(f"ERRO {erro}", file=sys.stderr)
+    return 1 if erros else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,95 +1,2266 @@
 import streamlit as st
-import pandas as pd
+import importlib
 import pytz
-import requests
 from io import StringIO
-from datetime import datetime
+from datetime import datetime, timedelta
 from streamlit_option_menu import option_menu
-import streamlit.components.v1 as components
 import time
+import json
+import logging
+import sqlite3
+import threading
+import uuid
+import hmac
+import io
+import os
+import re
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos
+    fcntl = None
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+class ModuloSobDemanda:
+    # Adia o import de módulos pesados até o primeiro uso: a tela inicial não
+    # precisa deles, e o aquecimento em segundo plano faz esse primeiro uso
+    def __init__(self, nome):
+        self._nome = nome
+
+    def __getattr__(self, atributo):
+        return getattr(importlib.import_module(self._nome), atributo)
+
+pd = ModuloSobDemanda("pandas")
+np = ModuloSobDemanda("numpy")
+pa = ModuloSobDemanda("pyarrow")
+requests = ModuloSobDemanda("requests")
 
 # --- GOOGLE SHEETS CONFIG ---
-import gspread
-from google.oauth2.service_account import Credentials
+gspread = ModuloSobDemanda("gspread")
+service_account = ModuloSobDemanda("google.oauth2.service_account")
+transporte_google = ModuloSobDemanda("google.auth.transport.requests")
 
-SPREADSHEET_KEY = st.secrets["spreadsheet"]["key"]
-SHEET_NAME = "Backstock"
+SHEET_NAME = "Backstock"  # aba legada; novos registros vão para partições mensais
+COLUNAS_PLANILHA = ["Usuário", "Bulto", "SKU", "Categoria", "Quantidade", "Data/Hora", "Lote"]
+COLUNAS_LEGADAS = ["Usuário", "Bulto", "SKU", "Categoria", "Data/Hora"]  # linhas sem Quantidade
+ARQUIVO_MESES_ATIVOS = 12  # partições mensais mais antigas que isso são compactadas em abas anuais
+RESUMO_SHEET_NAME = "Backstock Resumo"
+COLUNAS_RESUMO = ["Dia", "Usuário", "Categoria", "Bulto", "Peças", "Lote"]
+CHAVE_RESUMO = ["Dia", "Usuário", "Categoria", "Bulto"]
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive"
 ]
 
+# --- INSTRUMENTAÇÃO ---
+# Métricas do processo: tempo de cada rerun/etapa, chamadas ao Sheets e ao CSV
+# de usuários por operação, acertos de cache e uso da cota do Sheets na
+# última janela de 60 s. Exportáveis em JSON lines ou no formato do Prometheus.
+METRICAS_AMOSTRAS = 1000          # últimas durações guardadas por série (para p50/p99)
+COTA_LEITURA_POR_MINUTO = 60      # cota padrão do Sheets por usuário/minuto
+COTA_ESCRITA_POR_MINUTO = 60
+OPERACOES_ESCRITA = {
+    "add_worksheet", "del_worksheet", "append_row", "append_rows",
+    "update", "clear", "update_title", "batch_update",
+}
+logger_metricas = logging.getLogger("backstock.metricas")
+
+class Metricas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contadores = defaultdict(float)
+        self.duracoes = {}
+        self._cota = {"leitura": deque(), "escrita": deque()}
+        self.iniciado_em = time.time()
+
+    @staticmethod
+    def _chave(nome, labels):
+        return nome, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def contar(self, nome, valor=1, **labels):
+        with self._lock:
+            self.contadores[self._chave(nome, labels)] += valor
+
+    def observar(self, nome, segundos, **labels):
+        chave = self._chave(nome, labels)
+        with self._lock:
+            serie = self.duracoes.setdefault(chave, {"amostras": deque(maxlen=METRICAS_AMOSTRAS), "total": 0, "soma": 0.0})
+            serie["amostras"].append(segundos)
+            serie["total"] += 1
+            serie["soma"] += segundos
+        if logger_metricas.isEnabledFor(logging.DEBUG):  # sem serializar quando o log está desligado
+            logger_metricas.debug(json.dumps({"metrica": nome, "segundos": round(segundos, 6), **labels}, ensure_ascii=False))
+
+    @contextmanager
+    def medir(self, nome, **labels):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **labels)
+
+    def chamada_planilha(self, operacao, segundos, erro=None):
+        tipo = "escrita" if operacao in OPERACOES_ESCRITA else "leitura"
+        self.observar("sheets_chamada_segundos", segundos, operacao=operacao)
+        self.contar("sheets_chamadas_total", operacao=operacao, tipo=tipo)
+        if erro is not None:
+            self.contar("sheets_erros_total", operacao=operacao, erro=type(erro).__name__)
+        with self._lock:
+            self._cota[tipo].append(time.time())
+
+    def uso_cota(self):
+        limite = time.time() - 60
+        with self._lock:
+            for eventos in self._cota.values():
+                while eventos and eventos[0] < limite:
+                    eventos.popleft()
+            return {tipo: len(eventos) for tipo, eventos in self._cota.items()}
+
+    def tabela_duracoes(self):
+        with self._lock:
+            series = [(chave, list(s["amostras"]), s["total"], s["soma"]) for chave, s in self.duracoes.items()]
+        linhas = []
+        for (nome, labels), amostras, total, soma in series:
+            amostras.sort()
+            linhas.append({
+                "métrica": nome,
+                "labels": ", ".join(f"{k}={v}" for k, v in labels),
+                "n": total,
+                "média ms": 1000 * soma / total,
+                "p50 ms": 1000 * amostras[int(0.5 * (len(amostras) - 1))],
+                "p99 ms": 1000 * amostras[int(0.99 * (len(amostras) - 1))],
+            })
+        return pd.DataFrame(linhas)
+
+    def tabela_contadores(self):
+        with self._lock:
+            itens = list(self.contadores.items())
+        return pd.DataFrame([
+            {"métrica": nome, "labels": ", ".join(f"{k}={v}" for k, v in labels), "valor": valor}
+            for (nome, labels), valor in itens
+        ])
+
+    def taxas_cache(self):
+        with self._lock:
+            itens = list(self.contadores.items())
+        chamadas, falhas = defaultdict(float), defaultdict(float)
+        for (nome, labels), valor in itens:
+            cache = dict(labels).get("cache")
+            if nome == "cache_chamadas_total":
+                chamadas[cache] += valor
+            elif nome == "cache_falhas_total":
+                falhas[cache] += valor
+        return pd.DataFrame([
+            {"cache": cache, "chamadas": total, "acertos": total - falhas[cache],
+             "taxa de acerto": (total - falhas[cache]) / total if total else 0.0}
+            for cache, total in chamadas.items()
+        ])
+
+    def json_linhas(self):
+        agora = time.time()
+        linhas = []
+        with self._lock:
+            for (nome, labels), valor in self.contadores.items():
+                linhas.append({"ts": agora, "tipo": "contador", "metrica": nome, "labels": dict(labels), "valor": valor})
+            for (nome, labels), serie in self.duracoes.items():
+                linhas.append({"ts": agora, "tipo": "duracao", "metrica": nome, "labels": dict(labels),
+                               "n": serie["total"], "soma": serie["soma"], "amostras": list(serie["amostras"])})
+        for tipo, n in self.uso_cota().items():
+            linhas.append({"ts": agora, "tipo": "cota", "metrica": "sheets_cota_uso_60s", "labels": {"tipo": tipo}, "valor": n})
+        return "\n".join(json.dumps(linha, ensure_ascii=False) for linha in linhas) + "\n"
+
+    def prometheus(self):
+        def rotulos(labels, **extra):
+            pares = list(labels) + list(extra.items())
+            if not pares:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in pares) + "}"
+        saida = []
+        with self._lock:
+            contadores = sorted(self.contadores.items())
+            duracoes = sorted((chave, sorted(s["amostras"]), s["total"], s["soma"]) for chave, s in self.duracoes.items())
+        for nome in sorted({nome for (nome, _), _ in contadores}):
+            saida.append(f"# TYPE backstock_{nome} counter")
+            saida += [f"backstock_{nome}{rotulos(labels)} {valor}" for (n, labels), valor in contadores if n == nome]
+        for nome in sorted({nome for (nome, _), _, _, _ in duracoes}):
+            saida.append(f"# TYPE backstock_{nome} summary")
+            for (n, labels), amostras, total, soma in duracoes:
+                if n != nome:
+                    continue
+                for q in (0.5, 0.99):
+                    saida.append(f"backstock_{nome}{rotulos(labels, quantile=q)} {amostras[int(q * (len(amostras) - 1))]}")
+                saida.append(f"backstock_{nome}_sum{rotulos(labels)} {soma}")
+                saida.append(f"backstock_{nome}_count{rotulos(labels)} {total}")
+        saida.append("# TYPE backstock_sheets_cota_uso_60s gauge")
+        for tipo, n in self.uso_cota().items():
+            saida.append(f'backstock_sheets_cota_uso_60s{{tipo="{tipo}"}} {n}')
+        return "\n".join(saida) + "\n"
+
+@st.cache_resource
+def get_metricas():
+    return Metricas()
+
+class CacheInstrumentado:
+    # Envolve uma função com st.cache_* contando chamadas; a própria função
+    # conta as falhas (o corpo só roda quando o cache não tem o valor)
+    def __init__(self, nome, funcao):
+        self.nome = nome
+        self._funcao = funcao
+
+    def __call__(self, *args, **kwargs):
+        get_metricas().contar("cache_chamadas_total", cache=self.nome)
+        return self._funcao(*args, **kwargs)
+
+    def clear(self, *args, **kwargs):
+        return self._funcao.clear(*args, **kwargs)
+
+class ObjetoInstrumentado:
+    # Proxy que mede toda chamada de método do gspread (planilha e abas)
+    def __init__(self, alvo):
+        self._alvo = alvo
+
+    def __getattr__(self, nome):
+        atributo = getattr(self._alvo, nome)
+        if not callable(atributo):
+            return atributo
+
+        def chamada(*args, **kwargs):
+            tipo = "escrita" if nome in OPERACOES_ESCRITA else "leitura"
+            limitador = get_limitador_cota()[tipo]
+            esperado = limitador.adquirir()
+            if esperado:
+                get_metricas().observar("sheets_limitador_espera_segundos", esperado, tipo=tipo)
+            inicio = time.perf_counter()
+            erro = None
+            try:
+                resultado = atributo(*args, **kwargs)
+            except Exception as e:
+                erro = e
+                if eh_cota_excedida(e):
+                    limitador.cota_excedida(pausa_cota_excedida(e))
+                    get_metricas().contar("sheets_cota_excedida_total", tipo=tipo)
+                raise
+            finally:
+                get_metricas().chamada_planilha(nome, time.perf_counter() - inicio, erro)
+            if nome in ("worksheet", "add_worksheet"):
+                return ObjetoInstrumentado(resultado)
+            if nome == "worksheets":
+                return [ObjetoInstrumentado(ws) for ws in resultado]
+            return resultado
+        return chamada
+
+def _desembrulhar(objeto):
+    return objeto._alvo if isinstance(objeto, ObjetoInstrumentado) else objeto
+
+def ler_secao_secrets(secao):
+    try:
+        return dict(st.secrets.get(secao, {}))
+    except Exception:
+        return {}  # sem secrets.toml (ex.: modo local/simulado)
+
+def admin_autorizado():
+    # Manutenção só com [admin] senha nos secrets e a senha digitada na sessão
+    senha = str(ler_secao_secrets("admin").get("senha") or "")
+    if not senha:
+        st.info("Manutenção desativada: configure `[admin] senha` nos secrets.")
+        return False
+    digitada = st.text_input("Senha de administrador", type="password", key="senha_admin")
+    if not digitada:
+        return False
+    if not hmac.compare_digest(digitada.encode(), senha.encode()):
+        st.error("Senha incorreta.")
+        return False
+    return True
+
+def pedir_manutencao(acao):
+    # Cada ação de manutenção exige marcar a confirmação de novo
+    st.session_state[f"confirmar_{acao}"] = False
+    st.session_state["acao_manutencao"] = acao
+
+# --- LIMITE DE COTA DO SHEETS ---
+# Token bucket por tipo de chamada, compartilhado por todas as sessões: a
+# capacidade é a cota do minuto e os tokens voltam continuamente. Sem token, a
+# chamada espera em vez de estourar a cota; um 429 esvazia o balde e pausa o tipo.
+COTA_PAUSA_429 = 10.0   # pausa (s) após um 429 sem Retry-After
+
+class LimitadorCota:
+    def __init__(self, por_minuto):
+        self.capacidade = float(por_minuto)
+        self.taxa = por_minuto / 60.0
+        self._tokens = self.capacidade
+        self._atualizado = time.monotonic()
+        self._pausado_ate = 0.0
+        self._lock = threading.Lock()
+
+    def _repor(self, agora):
+        self._tokens = min(self.capacidade, self._tokens + (agora - self._atualizado) * self.taxa)
+        self._atualizado = agora
+
+    def adquirir(self):
+        # Bloqueia até haver um token; devolve quanto tempo esperou
+        esperado = 0.0
+        while True:
+            with self._lock:
+                agora = time.monotonic()
+                self._repor(agora)
+                if agora >= self._pausado_ate and self._tokens >= 1:
+                    self._tokens -= 1
+                    return esperado
+                espera = max(self._pausado_ate - agora, (1 - self._tokens) / self.taxa)
+            time.sleep(espera)
+            esperado += espera
+
+    def cota_excedida(self, segundos):
+        with self._lock:
+            self._tokens = 0.0
+            self._pausado_ate = max(self._pausado_ate, time.monotonic() + segundos)
+
+def eh_cota_excedida(erro):
+    resposta = getattr(erro, "response", None)
+    return isinstance(erro, gspread.exceptions.APIError) and getattr(resposta, "status_code", None) == 429
+
+def pausa_cota_excedida(erro):
+    try:
+        return float(erro.response.headers.get("Retry-After", COTA_PAUSA_429))
+    except (TypeError, ValueError):
+        return COTA_PAUSA_429
+
+@st.cache_resource
+def get_limitador_cota():
+    return {"leitura": LimitadorCota(COTA_LEITURA_POR_MINUTO), "escrita": LimitadorCota(COTA_ESCRITA_POR_MINUTO)}
+
+# --- POOL HTTP COMPARTILHADO ---
+# Um único adaptador (pool de conexões keep-alive) montado na sessão do gspread e
+# na do CSV de usuários: o handshake TLS é pago uma vez por host, não por sessão.
+HTTP_POOL_MAX = 10
+
+@st.cache_resource
+def get_pool_http():
+    return requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAX)
+
+def montar_pool_http(sessao):
+    adaptador = get_pool_http()
+    sessao.mount("https://", adaptador)
+    sessao.mount("http://", adaptador)
+    return sessao
+
 @st.cache_resource(ttl=300)
 def get_google_sheet():
-    sa_info = st.secrets["gcp_service_account"]
-    creds = Credentials.from_service_account_info(sa_info, scopes=SCOPES)
-    client = gspread.authorize(creds)
-    spreadsheet = client.open_by_key(SPREADSHEET_KEY)
-    return spreadsheet
+    get_metricas().contar("cache_falhas_total", cache="get_google_sheet")
+    with get_metricas().medir("sheets_conexao_segundos"):
+        sa_info = st.secrets["gcp_service_account"]
+        creds = service_account.Credentials.from_service_account_info(sa_info, scopes=SCOPES)
+        sessao = montar_pool_http(transporte_google.AuthorizedSession(creds))
+        client = gspread.authorize(creds, session=sessao)
+        spreadsheet = client.open_by_key(st.secrets["spreadsheet"]["key"])
+    return ObjetoInstrumentado(spreadsheet)
 
-@st.cache_data(ttl=120, show_spinner="Carregando registros da planilha...")
-def load_backstock_data():
-    try:
-        sheet = get_google_sheet().worksheet(SHEET_NAME)
-        data = sheet.get_all_records()
-        if data:
-            return pd.DataFrame(data)
+get_google_sheet = CacheInstrumentado("get_google_sheet", get_google_sheet)
+
+# --- LEITURA INCREMENTAL (TAIL-SYNC) ---
+# A aba é append-only na prática: depois da primeira carga completa só buscamos
+# as linhas novas. Se a aba encolher ou o cabeçalho mudar, refazemos a carga completa.
+def _linha_normalizada(valores):
+    valores = [str(v) for v in valores]
+    while valores and valores[-1] == "":
+        valores.pop()
+    return valores
+
+class SincronizadorAba:
+    def __init__(self, nome_aba, abrir_planilha):
+        self.nome_aba = nome_aba
+        self._abrir_planilha = abrir_planilha
+        self._lock = threading.Lock()
+        self._sheet = None
+        self.cabecalho = None
+        self.linhas_lidas = 0       # linhas da aba já lidas, incluindo o cabeçalho
+        self.ultima_linha = None    # conteúdo da última linha lida, para detectar alterações
+        self.df = pd.DataFrame()
+        self.cargas_completas = 0
+        self.cargas_incrementais = 0
+
+    def _aba(self):
+        if self._sheet is None:
+            self._sheet = self._abrir_planilha().worksheet(self.nome_aba)
+        return self._sheet
+
+    def _montar_df(self, linhas):
+        largura = len(self.cabecalho)
+        linhas = [(r + [""] * largura)[:largura] for r in linhas if any(v != "" for v in r)]
+        return pd.DataFrame(linhas, columns=self.cabecalho)
+
+    def _carga_completa(self):
+        valores = self._aba().get_all_values()
+        self.cargas_completas += 1
+        if not valores:
+            self.cabecalho = None
+            self.linhas_lidas = 0
+            self.ultima_linha = None
+            self.df = pd.DataFrame()
+            return
+        self.cabecalho = _linha_normalizada(valores[0])
+        self.linhas_lidas = len(valores)
+        self.ultima_linha = _linha_normalizada(valores[-1])
+        self.df = self._montar_df([list(map(str, r)) for r in valores[1:]])
+
+    def _carga_incremental(self):
+        ultima_coluna = gspread.utils.rowcol_to_a1(1, len(self.cabecalho)).rstrip("0123456789")
+        cabecalho, cauda = self._aba().batch_get(["1:1", f"A{self.linhas_lidas}:{ultima_coluna}"])
+        self.cargas_incrementais += 1
+        if (
+            _linha_normalizada(cabecalho[0] if cabecalho else []) != self.cabecalho
+            or not cauda
+            or _linha_normalizada(cauda[0]) != self.ultima_linha
+        ):
+            return False
+        novas = [list(map(str, r)) for r in cauda[1:]]
+        if novas:
+            self.df = pd.concat([self.df, self._montar_df(novas)], ignore_index=True)
+            self.linhas_lidas += len(novas)
+            self.ultima_linha = _linha_normalizada(novas[-1])
+        return True
+
+    def atualizar(self):
+        with self._lock:
+            try:
+                if self.cabecalho is None or not self._carga_incremental():
+                    self._carga_completa()
+            except Exception:
+                self._sheet = None
+                raise
+            return self.df
+
+# --- ARMAZENAMENTO ---
+# Toda a persistência passa por um objeto com a mesma interface:
+#   listar_abas, ler, ler_registros, anexar, reescrever, renomear, apagar.
+# O SQLite tem ainda ler_intervalo, que filtra por dia no próprio banco.
+# O backend é escolhido em secrets.toml, seção [storage]:
+#   backend = "sheets" (padrão) | "sqlite" | "fake"
+SQLITE_PATH = "backstock_local.db"
+REESCRITA_BLOCO = 10000     # linhas por chamada ao reescrever uma aba da planilha
+
+@st.cache_resource
+def _classe_aba_nao_encontrada():
+    # Criada uma vez por processo: classes definidas no corpo do script são
+    # recriadas a cada rerun, e o "except" não pegaria a exceção levantada por
+    # um objeto guardado em st.cache_resource numa execução anterior
+    class AbaNaoEncontrada(LookupError):
+        pass
+    return AbaNaoEncontrada
+
+AbaNaoEncontrada = _classe_aba_nao_encontrada()
+
+def linhas_acrescentadas(lidos, atuais):
+    # Linhas anexadas à aba depois de "lidos", ou None se ela mudou de outro jeito
+    if len(atuais) < len(lidos) or (lidos and atuais[len(lidos) - 1] != lidos[-1]):
+        return None
+    return atuais[len(lidos):]
+
+def erro_aba_alterada(nome_aba):
+    return RuntimeError(f"A aba '{nome_aba}' foi alterada durante a reescrita; nada foi trocado, tente de novo.")
+
+def registros_da_aba(valores):
+    # Converte get_all_values() em registros (dicts) indexados pelo cabeçalho
+    if not valores:
+        return []
+    cabecalho = valores[0]
+    return [dict(zip(cabecalho, r)) for r in valores[1:] if any(r)]
+
+class ArmazenamentoPlanilha:
+    # Google Sheets via gspread; também usado com o simulador (PlanilhaSimulada)
+    def __init__(self, abrir_planilha):
+        self._abrir_planilha = abrir_planilha
+        self._lock = threading.Lock()
+        self._abas = {}             # abas com cabeçalho já conferido: nome -> (worksheet, cabeçalho)
+        self._sincronizadores = {}
+
+    def _worksheet(self, nome_aba):
+        try:
+            return self._abrir_planilha().worksheet(nome_aba)
+        except gspread.WorksheetNotFound:
+            raise AbaNaoEncontrada(nome_aba)
+
+    def listar_abas(self):
+        return {ws.title for ws in self._abrir_planilha().worksheets()}
+
+    def _obter_aba(self, nome_aba, expected_columns):
+        # Retorna (worksheet, cabeçalho real da aba); colunas que faltarem são
+        # acrescentadas ao fim do cabeçalho para não desalinhar as linhas antigas
+        with self._lock:
+            if nome_aba in self._abas:
+                return self._abas[nome_aba]
+            spreadsheet = self._abrir_planilha()
+            try:
+                sheet = spreadsheet.worksheet(nome_aba)
+            except gspread.WorksheetNotFound:
+                sheet = spreadsheet.add_worksheet(title=nome_aba, rows="1000", cols="20")
+                sheet.append_row(expected_columns)  # Cabeçalho
+                cabecalho = list(expected_columns)
+            else:
+                # Lê só a primeira linha em vez da planilha inteira
+                cabecalho = _linha_normalizada(sheet.row_values(1))
+                if not cabecalho:
+                    sheet.append_row(expected_columns)
+                    cabecalho = list(expected_columns)
+                faltando = [col for col in expected_columns if col not in cabecalho]
+                if faltando:
+                    inicio = gspread.utils.rowcol_to_a1(1, len(cabecalho) + 1)
+                    sheet.update(values=[faltando], range_name=inicio)
+                    cabecalho += faltando
+            self._abas[nome_aba] = (sheet, cabecalho)
+            return sheet, cabecalho
+
+    def esquecer_aba(self, nome_aba):
+        # Força nova verificação do cabeçalho (ex.: aba apagada ou recriada)
+        with self._lock:
+            self._abas.pop(nome_aba, None)
+            self._sincronizadores.pop(nome_aba, None)
+
+    def anexar(self, nome_aba, registros, expected_columns):
+        sheet, cabecalho = self._obter_aba(nome_aba, expected_columns)
+        rows = [[registro.get(col, "") for col in cabecalho] for registro in registros]
+        try:
+            sheet.append_rows(rows)  # <- ENVIA TODAS AS LINHAS DE UMA VEZ
+        except Exception:
+            self.esquecer_aba(nome_aba)
+            raise
+
+    def ler(self, nome_aba):
+        with self._lock:
+            if nome_aba not in self._sincronizadores:
+                self._sincronizadores[nome_aba] = SincronizadorAba(nome_aba, self._abrir_planilha)
+            sincronizador = self._sincronizadores[nome_aba]
+        try:
+            return sincronizador.atualizar()
+        except gspread.WorksheetNotFound:
+            raise AbaNaoEncontrada(nome_aba)
+
+    def ler_registros(self, nome_aba):
+        valores = self._worksheet(nome_aba).get_all_values()
+        cabecalho = _linha_normalizada(valores[0]) if valores else []
+        largura = len(cabecalho)
+        return cabecalho, registros_da_aba([cabecalho] + [(list(r) + [""] * largura)[:largura] for r in valores[1:]])
+
+    def reescrever(self, nome_aba, cabecalho, registros, lidos):
+        # O conteúdo novo vai para uma aba temporária, em blocos, e só então
+        # troca de lugar com a original: uma falha no meio nunca deixa a aba vazia.
+        # flush_lock só vale neste host: antes da troca a original é relida e
+        # comparada com "lidos" (o que o chamador leu); linhas anexadas no fim
+        # entram na aba nova, qualquer outra mudança cancela a reescrita
+        original = self._worksheet(nome_aba)
+        spreadsheet = self._abrir_planilha()
+        nome_temporario = f"{nome_aba} (reescrita)"
+        try:
+            spreadsheet.del_worksheet(_desembrulhar(spreadsheet.worksheet(nome_temporario)))  # sobra de falha anterior
+        except gspread.WorksheetNotFound:
+            pass
+        valores = [list(cabecalho)] + [[r.get(col, "") for col in cabecalho] for r in registros]
+        temporaria = spreadsheet.add_worksheet(title=nome_temporario, rows=str(len(valores)), cols=str(max(len(cabecalho), 1)))
+        try:
+            for inicio in range(0, len(valores), REESCRITA_BLOCO):
+                temporaria.update(values=valores[inicio:inicio + REESCRITA_BLOCO], range_name=f"A{inicio + 1}")
+            novas = linhas_acrescentadas(lidos, self.ler_registros(nome_aba)[1])
+            if novas is None:
+                raise erro_aba_alterada(nome_aba)
+            if novas:
+                temporaria.append_rows([[r.get(col, "") for col in cabecalho] for r in novas])
+        except Exception:
+            spreadsheet.del_worksheet(_desembrulhar(temporaria))
+            raise
+        nome_antigo = f"{nome_aba} (antes da reescrita)"
+        original.update_title(nome_antigo)
+        try:
+            temporaria.update_title(nome_aba)
+        except Exception:
+            original.update_title(nome_aba)
+            raise
+        self.esquecer_aba(nome_aba)
+        spreadsheet.del_worksheet(_desembrulhar(original))
+
+    def renomear(self, nome_aba, novo_nome):
+        self._worksheet(nome_aba).update_title(novo_nome)
+        self.esquecer_aba(nome_aba)
+
+    def apagar(self, nome_aba):
+        self._abrir_planilha().del_worksheet(_desembrulhar(self._worksheet(nome_aba)))
+        self.esquecer_aba(nome_aba)
+
+class ArmazenamentoSQLite:
+    # Banco local; cada "aba" é um conjunto de linhas na mesma tabela, com os
+    # valores originais em JSON e lidas em ordem pelo índice (aba, id), ou por
+    # (aba, dia) quando só um intervalo de dias interessa. Bulto e usuário ficam
+    # em colunas próprias só para consultas diretas no banco
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS abas (nome TEXT PRIMARY KEY, cabecalho TEXT NOT NULL)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS registros (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                aba TEXT NOT NULL,
+                dia TEXT,
+                bulto TEXT,
+                usuario TEXT,
+                dados TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_registros_aba ON registros (aba, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_registros_aba_dia ON registros (aba, dia)")
+        for indice in ("idx_registros_dia", "idx_registros_bulto", "idx_registros_usuario"):
+            self._conn.execute(f"DROP INDEX IF EXISTS {indice}")  # nenhuma leitura os usava; só pesavam nas escritas
+
+    def _cabecalho(self, nome_aba):
+        row = self._conn.execute("SELECT cabecalho FROM abas WHERE nome = ?", (nome_aba,)).fetchone()
+        if row is None:
+            raise AbaNaoEncontrada(nome_aba)
+        return json.loads(row[0])
+
+    @staticmethod
+    def _linha_indexada(nome_aba, registro):
+        if registro.get("Data/Hora"):
+            data = data_do_registro(registro["Data/Hora"])
+            dia = data.strftime("%Y-%m-%d") if data else None
         else:
+            dia = registro.get("Dia") or None
+        dados = {col: "" if valor is None else str(valor) for col, valor in registro.items()}
+        return (nome_aba, dia, dados.get("Bulto"), dados.get("Usuário"), json.dumps(dados, ensure_ascii=False))
+
+    def listar_abas(self):
+        with self._lock:
+            return {nome for (nome,) in self._conn.execute("SELECT nome FROM abas")}
+
+    def anexar(self, nome_aba, registros, expected_columns):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                try:
+                    cabecalho = self._cabecalho(nome_aba)
+                except AbaNaoEncontrada:
+                    cabecalho = []
+                faltando = [col for col in expected_columns if col not in cabecalho]
+                if faltando:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO abas (nome, cabecalho) VALUES (?, ?)",
+                        (nome_aba, json.dumps(cabecalho + faltando, ensure_ascii=False))
+                    )
+                self._conn.executemany(
+                    "INSERT INTO registros (aba, dia, bulto, usuario, dados) VALUES (?, ?, ?, ?, ?)",
+                    [self._linha_indexada(nome_aba, r) for r in registros]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _registros(self, nome_aba):
+        cabecalho = self._cabecalho(nome_aba)
+        cur = self._conn.execute("SELECT dados FROM registros WHERE aba = ? ORDER BY id", (nome_aba,))
+        registros = [json.loads(dados) for (dados,) in cur]
+        return cabecalho, [{col: r.get(col, "") for col in cabecalho} for r in registros]
+
+    def ler_registros(self, nome_aba):
+        with self._lock:
+            return self._registros(nome_aba)
+
+    def ler(self, nome_aba):
+        cabecalho, registros = self.ler_registros(nome_aba)
+        if not registros:
             return pd.DataFrame()
+        return pd.DataFrame(registros, columns=cabecalho)
+
+    def ler_intervalo(self, nome_aba, inicio, fim):
+        # Só as linhas com dia entre inicio e fim ("AAAA-MM-DD", inclusive)
+        with self._lock:
+            cabecalho = self._cabecalho(nome_aba)
+            cur = self._conn.execute(
+                "SELECT dados FROM registros WHERE aba = ? AND dia BETWEEN ? AND ? ORDER BY id",
+                (nome_aba, inicio, fim)
+            )
+            registros = [json.loads(dados) for (dados,) in cur]
+        if not registros:
+            return pd.DataFrame()
+        return pd.DataFrame([{col: r.get(col, "") for col in cabecalho} for r in registros], columns=cabecalho)
+
+    def reescrever(self, nome_aba, cabecalho, registros, lidos):
+        # Conferência e troca na mesma transação (IMMEDIATE: vale entre processos)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                novas = linhas_acrescentadas(lidos, self._registros(nome_aba)[1])
+                if novas is None:
+                    raise erro_aba_alterada(nome_aba)
+                registros = list(registros) + novas
+                self._conn.execute("DELETE FROM registros WHERE aba = ?", (nome_aba,))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO abas (nome, cabecalho) VALUES (?, ?)",
+                    (nome_aba, json.dumps(list(cabecalho), ensure_ascii=False))
+                )
+                self._conn.executemany(
+                    "INSERT INTO registros (aba, dia, bulto, usuario, dados) VALUES (?, ?, ?, ?, ?)",
+                    [self._linha_indexada(nome_aba, r) for r in registros]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def renomear(self, nome_aba, novo_nome):
+        with self._lock:
+            self._cabecalho(nome_aba)
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("UPDATE abas SET nome = ? WHERE nome = ?", (novo_nome, nome_aba))
+                self._conn.execute("UPDATE registros SET aba = ? WHERE aba = ?", (novo_nome, nome_aba))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def apagar(self, nome_aba):
+        with self._lock:
+            self._cabecalho(nome_aba)
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM registros WHERE aba = ?", (nome_aba,))
+                self._conn.execute("DELETE FROM abas WHERE nome = ?", (nome_aba,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def esquecer_aba(self, nome_aba):
+        pass  # nada em cache
+
+# --- SIMULADOR DO GOOGLE SHEETS ---
+# Imita a parte da API do gspread usada pelo app, com latência e erro 429 de
+# cota, para testes de carga e uso sem rede (backend = "fake").
+SIMULADOR_LATENCIA = (0.05, 0.25)   # segundos (mín., máx.) por chamada
+SIMULADOR_COTA_POR_MINUTO = 60      # leituras e escritas contam separadamente, como no Sheets
+
+def erro_cota_excedida():
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps({"error": {
+        "code": 429,
+        "message": "Quota exceeded (simulador)",
+        "status": "RESOURCE_EXHAUSTED",
+    }}).encode()
+    return gspread.exceptions.APIError(response)
+
+class PlanilhaSimulada:
+    def __init__(self, latencia=SIMULADOR_LATENCIA, cota_por_minuto=SIMULADOR_COTA_POR_MINUTO):
+        self.latencia = latencia
+        self.cota_por_minuto = cota_por_minuto
+        self._lock = threading.Lock()
+        self._abas = {}
+        self._chamadas = {"leitura": [], "escrita": []}
+        self.contadores = {}
+
+    def _chamada(self, tipo, operacao):
+        agora = time.time()
+        with self._lock:
+            self.contadores[operacao] = self.contadores.get(operacao, 0) + 1
+            janela = [t for t in self._chamadas[tipo] if agora - t < 60]
+            if self.cota_por_minuto and len(janela) >= self.cota_por_minuto:
+                self._chamadas[tipo] = janela
+                raise erro_cota_excedida()
+            janela.append(agora)
+            self._chamadas[tipo] = janela
+        if self.latencia:
+            time.sleep(np.random.uniform(*self.latencia))
+
+    def worksheet(self, title):
+        self._chamada("leitura", "worksheet")
+        with self._lock:
+            if title not in self._abas:
+                raise gspread.WorksheetNotFound(title)
+            return self._abas[title]
+
+    def worksheets(self):
+        self._chamada("leitura", "worksheets")
+        with self._lock:
+            return list(self._abas.values())
+
+    def add_worksheet(self, title, rows, cols):
+        self._chamada("escrita", "add_worksheet")
+        with self._lock:
+            self._abas[title] = AbaSimulada(self, title)
+            return self._abas[title]
+
+    def del_worksheet(self, worksheet):
+        self._chamada("escrita", "del_worksheet")
+        with self._lock:
+            self._abas.pop(worksheet.title, None)
+
+class AbaSimulada:
+    def __init__(self, planilha, title):
+        self._planilha = planilha
+        self.title = title
+        self._linhas = []
+
+    def _intervalo(self, a1):
+        if a1 == "1:1":
+            return [list(self._linhas[0])] if self._linhas else []
+        inicio = a1.split(":")[0]
+        linha = int("".join(c for c in inicio if c.isdigit()))
+        return [list(r) for r in self._linhas[linha - 1:]]
+
+    def get_all_values(self):
+        self._planilha._chamada("leitura", "get_all_values")
+        return [list(r) for r in self._linhas]
+
+    def batch_get(self, ranges, **kwargs):
+        self._planilha._chamada("leitura", "batch_get")
+        return [self._intervalo(a1) for a1 in ranges]
+
+    def row_values(self, row):
+        self._planilha._chamada("leitura", "row_values")
+        return list(self._linhas[row - 1]) if len(self._linhas) >= row else []
+
+    def append_row(self, values, **kwargs):
+        self._planilha._chamada("escrita", "append_row")
+        self._linhas.append([str(v) for v in values])
+
+    def append_rows(self, values, **kwargs):
+        self._planilha._chamada("escrita", "append_rows")
+        self._linhas.extend([str(v) for v in r] for r in values)
+
+    def update(self, values=None, range_name=None, **kwargs):
+        self._planilha._chamada("escrita", "update")
+        linha, coluna = gspread.utils.a1_to_rowcol(range_name or "A1")
+        for i, valores in enumerate(values):
+            while len(self._linhas) < linha + i:
+                self._linhas.append([])
+            atual = self._linhas[linha + i - 1]
+            atual.extend([""] * (coluna - 1 + len(valores) - len(atual)))
+            atual[coluna - 1:coluna - 1 + len(valores)] = [str(v) for v in valores]
+
+    def clear(self):
+        self._planilha._chamada("escrita", "clear")
+        self._linhas = []
+
+    def update_title(self, title):
+        self._planilha._chamada("escrita", "update_title")
+        with self._planilha._lock:
+            self._planilha._abas[title] = self._planilha._abas.pop(self.title)
+        self.title = title
+
+@st.cache_resource
+def get_armazenamento():
+    config = ler_secao_secrets("storage")
+    backend = config.get("backend", "sheets")
+    if backend == "sqlite":
+        return ArmazenamentoSQLite(config.get("path", SQLITE_PATH))
+    if backend == "fake":
+        planilha = PlanilhaSimulada(
+            latencia=(config.get("latencia_min", SIMULADOR_LATENCIA[0]), config.get("latencia_max", SIMULADOR_LATENCIA[1])),
+            cota_por_minuto=config.get("cota_por_minuto", SIMULADOR_COTA_POR_MINUTO),
+        )
+        instrumentada = ObjetoInstrumentado(planilha)
+        armazenamento = ArmazenamentoPlanilha(lambda: instrumentada)
+        armazenamento.simulador = planilha  # expõe contadores de chamadas (benchmark)
+        return armazenamento
+    return ArmazenamentoPlanilha(get_google_sheet)
+
+# --- SNAPSHOT COMPARTILHADO ENTRE RÉPLICAS ---
+# Cada aba lida é gravada em disco como um arquivo Arrow IPC versionado
+# ("Backstock_2025-07.v12.arrow") com um manifesto JSON apontando para a versão
+# atual. Só o processo que pega a trava da aba relê a planilha quando o
+# snapshot passa de SNAPSHOT_TTL; os demais (réplicas, workers) só leem o
+# arquivo quando a versão do manifesto muda (cada processo tem a própria cópia
+# em pandas). A versão entra na chave dos caches de leitura (versoes_das_abas).
+# Configurável em secrets.toml, seção [snapshot]: dir, ttl, enabled.
+SNAPSHOT_DIR = ".backstock_snapshots"
+SNAPSHOT_TTL = 120          # segundos até o snapshot ser relido da planilha
+SNAPSHOT_VERSOES = 2        # versões mantidas em disco para leitores atrasados
+
+class SnapshotsCompartilhados:
+    def __init__(self, diretorio, ttl):
+        self.diretorio = diretorio
+        self.ttl = ttl
+        os.makedirs(diretorio, exist_ok=True)
+        self._lock = threading.Lock()
+        self._carregados = {}  # aba -> (versão, DataFrame)
+
+    def _caminho(self, nome_aba, sufixo):
+        return os.path.join(self.diretorio, re.sub(r"[^0-9A-Za-z_-]+", "_", nome_aba) + sufixo)
+
+    def _ler_json(self, caminho):
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _gravar_json(self, caminho, dados):
+        temporario = f"{caminho}.{os.getpid()}.tmp"
+        with open(temporario, "w", encoding="utf-8") as f:
+            json.dump(dados, f)
+        os.replace(temporario, caminho)  # troca atômica: leitores nunca veem arquivo pela metade
+
+    def _velho(self, manifesto):
+        expirado = self._ler_json(os.path.join(self.diretorio, "expirado_em.json")) or 0
+        return manifesto is None or manifesto["gerado_em"] < max(time.time() - self.ttl, expirado)
+
+    def expirar(self):
+        # Vale para todos os processos: o próximo leitor de cada aba relê a planilha
+        self._gravar_json(os.path.join(self.diretorio, "expirado_em.json"), time.time())
+
+    def _atualizar(self, nome_aba, carregar, esperar):
+        with open(self._caminho(nome_aba, ".lock"), "w") as trava:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(trava, fcntl.LOCK_EX | (0 if esperar else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    return None  # outro processo já está atualizando; fica com a versão atual
+            manifesto = self._ler_json(self._caminho(nome_aba, ".json"))
+            if not self._velho(manifesto):
+                return manifesto  # atualizado enquanto esperávamos a trava
+            versao = (manifesto["versao"] if manifesto else 0) + 1
+            try:
+                df = carregar()
+            except AbaNaoEncontrada:
+                arquivo = None  # também vira snapshot, para as réplicas não perguntarem de novo
+            else:
+                arquivo = self._caminho(nome_aba, f".v{versao}.arrow")
+                tabela = pa.Table.from_pandas(df.astype(str), preserve_index=False)  # a planilha só tem texto
+                with pa.OSFile(f"{arquivo}.tmp", "wb") as destino:
+                    with pa.ipc.new_file(destino, tabela.schema) as escritor:
+                        escritor.write_table(tabela)
+                os.replace(f"{arquivo}.tmp", arquivo)
+            manifesto = {"versao": versao, "gerado_em": time.time(), "arquivo": arquivo and os.path.basename(arquivo)}
+            self._gravar_json(self._caminho(nome_aba, ".json"), manifesto)
+            antigo = self._caminho(nome_aba, f".v{versao - SNAPSHOT_VERSOES}.arrow")
+            if os.path.exists(antigo):
+                os.remove(antigo)
+            get_metricas().contar("snapshot_atualizacoes_total", aba=nome_aba)
+            return manifesto
+
+    def _manifesto(self, nome_aba, carregar):
+        manifesto = self._ler_json(self._caminho(nome_aba, ".json"))
+        if self._velho(manifesto):
+            try:
+                manifesto = self._atualizar(nome_aba, carregar, esperar=manifesto is None) or manifesto
+            except Exception:
+                if manifesto is None:
+                    raise
+                get_metricas().contar("snapshot_erros_total", aba=nome_aba)  # serve a versão anterior
+        return manifesto
+
+    def versao(self, nome_aba, carregar):
+        return self._manifesto(nome_aba, carregar)["versao"]
+
+    def ler(self, nome_aba, carregar):
+        manifesto = self._manifesto(nome_aba, carregar)
+        if manifesto["arquivo"] is None:
+            raise AbaNaoEncontrada(nome_aba)
+        with self._lock:
+            versao, df = self._carregados.get(nome_aba, (None, None))
+        if versao == manifesto["versao"]:
+            return df
+        with pa.memory_map(os.path.join(self.diretorio, manifesto["arquivo"])) as fonte:
+            df = pa.ipc.open_file(fonte).read_all().to_pandas()
+        get_metricas().contar("snapshot_leituras_total", aba=nome_aba)
+        with self._lock:
+            self._carregados[nome_aba] = (manifesto["versao"], df)
+        return df
+
+@st.cache_resource
+def get_snapshots():
+    # Sem snapshot no backend SQLite: os dados já são locais
+    config = ler_secao_secrets("snapshot")
+    if not config.get("enabled", ler_secao_secrets("storage").get("backend", "sheets") != "sqlite"):
+        return None
+    return SnapshotsCompartilhados(config.get("dir", SNAPSHOT_DIR), config.get("ttl", SNAPSHOT_TTL))
+
+def ler_aba(nome_aba):
+    armazenamento = get_armazenamento()
+    snapshots = get_snapshots()
+    if snapshots is None:
+        return armazenamento.ler(nome_aba)
+    return snapshots.ler(nome_aba, lambda: armazenamento.ler(nome_aba))
+
+def ler_aba_do_mes(nome_aba, mes):
+    # Com o SQLite só o mês vem do banco: a aba anual e a legada não são lidas
+    # inteiras. A planilha não tem consulta por data e é lida inteira
+    ler_intervalo = getattr(get_armazenamento(), "ler_intervalo", None)
+    if ler_intervalo is None:
+        return ler_aba(nome_aba)
+    fim = (mes + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return ler_intervalo(nome_aba, f"{mes:%Y-%m-01}", f"{fim:%Y-%m-%d}")
+
+def versoes_das_abas(abas):
+    # Com snapshots, a versão de cada aba entra na chave dos caches de leitura
+    # (load_backstock_data, load_resumo, load_backstock_modelo): eles acompanham
+    # o snapshot em vez de somar o próprio TTL ao dele
+    snapshots = get_snapshots()
+    if snapshots is None:
+        return None
+    armazenamento = get_armazenamento()
+    versoes = []
+    for aba in abas:
+        try:
+            versoes.append(snapshots.versao(aba, lambda aba=aba: armazenamento.ler(aba)))
+        except Exception:
+            versoes.append(None)  # o erro aparece na leitura, em load_backstock_data
+    return tuple(versoes)
+
+def expirar_snapshots():
+    snapshots = get_snapshots()
+    if snapshots is not None:
+        snapshots.expirar()
+
+@st.cache_data(ttl=120, show_spinner="Carregando registros da planilha...")
+def load_backstock_data(nome_aba=SHEET_NAME, versao=None, mes=None):
+    get_metricas().contar("cache_falhas_total", cache="load_backstock_data")
+    try:
+        if mes is not None:
+            return ler_aba_do_mes(nome_aba, mes).copy()
+        return ler_aba(nome_aba).copy()
+    except AbaNaoEncontrada:
+        return pd.DataFrame()  # partição ainda sem registros
     except Exception as e:
         st.error(f"Erro ao carregar dados da planilha: {e}")
         return pd.DataFrame()
 
-def salvar_bulto_na_planilha(df_bulto):
-    # Garante que só as colunas corretas vão para a planilha
-    expected_columns = ["Usuário", "Bulto", "SKU", "Categoria", "Data/Hora"]
-    df_bulto = df_bulto.loc[:, expected_columns]
+load_backstock_data = CacheInstrumentado("load_backstock_data", load_backstock_data)
+
+# --- PARTICIONAMENTO POR MÊS ---
+# Cada mês fica em sua própria aba ("Backstock 2025-07"); meses antigos são
+# compactados em uma aba por ano ("Backstock Arquivo 2024").
+def nome_particao(data):
+    return f"{SHEET_NAME} {data:%Y-%m}"
+
+def nome_arquivo(ano):
+    return f"{SHEET_NAME} Arquivo {ano}"
+
+# Linhas cuja Data/Hora não pode ser lida não entram em mês nenhum
+SEM_DATA_SHEET_NAME = f"{SHEET_NAME} Sem data"
+
+def data_do_registro(data_hora):
+    # None quando a data não pode ser lida: nunca inventa uma data
     try:
-        spreadsheet = get_google_sheet()
+        return datetime.strptime(str(data_hora), FORMATO_DATA_HORA)
+    except ValueError:
+        convertida = pd.to_datetime(str(data_hora), dayfirst=True, errors="coerce")
+        return None if pd.isna(convertida) else convertida.to_pydatetime()
+
+def quantidade_do_registro(registro):
+    try:
+        return max(int(float(registro.get("Quantidade") or 1)), 1)
+    except (TypeError, ValueError):
+        return 1
+
+def agrupar_por_particao(registros):
+    grupos = {}
+    for registro in registros:
+        data = data_do_registro(registro["Data/Hora"])
+        grupos.setdefault(nome_particao(data) if data else SEM_DATA_SHEET_NAME, []).append(registro)
+    return grupos
+
+@st.cache_resource(ttl=300)
+def listar_abas():
+    return get_armazenamento().listar_abas()
+
+def particoes_para_data(data):
+    abas = listar_abas()
+    candidatas = [nome_particao(data), nome_arquivo(data.year)]
+    if SHEET_NAME in abas:
+        candidatas.append(SHEET_NAME)  # aba legada ainda não migrada
+    return tuple(aba for aba in candidatas if aba in abas)
+
+def arquivar_particoes(hoje=None):
+    # Cada cópia (aba -> partição) concluída fica registrada no journal: se um
+    # passo falhar, repetir a operação não anexa de novo o que já foi copiado
+    hoje = hoje or datetime.now()
+    armazenamento = get_armazenamento()
+    journal = get_journal()
+    resumo = {"linhas_migradas": 0, "linhas_sem_data": 0, "particoes_arquivadas": []}
+    with journal.flush_lock:  # evita append do flusher no meio da migração
+        abas = armazenamento.listar_abas()
+        # 1. Distribui o conteúdo da aba legada nas partições mensais
+        if SHEET_NAME in abas:
+            _, registros = armazenamento.ler_registros(SHEET_NAME)
+            for nome, grupo in agrupar_por_particao(registros).items():
+                if nome == SEM_DATA_SHEET_NAME:
+                    resumo["linhas_sem_data"] = len(grupo)
+                if not journal.copia_concluida(SHEET_NAME, nome):
+                    armazenamento.anexar(nome, grupo, COLUNAS_PLANILHA)
+                    journal.marcar_copia(SHEET_NAME, nome)
+            resumo["linhas_migradas"] = len(registros)
+            armazenamento.renomear(SHEET_NAME, f"{SHEET_NAME} Legado migrado {hoje:%Y-%m-%d %H%M}")
+            journal.limpar_copias(SHEET_NAME)
+        # 1b. O mesmo para a aba de resumo única, dividida pelo mês do Dia
+        if RESUMO_SHEET_NAME in abas:
+            _, deltas = armazenamento.ler_registros(RESUMO_SHEET_NAME)
+            for nome, grupo in agrupar_resumo_por_mes(deltas).items():
+                if not journal.copia_concluida(RESUMO_SHEET_NAME, nome):
+                    armazenamento.anexar(nome, grupo, COLUNAS_RESUMO)
+                    journal.marcar_copia(RESUMO_SHEET_NAME, nome)
+            armazenamento.renomear(RESUMO_SHEET_NAME, f"{RESUMO_SHEET_NAME} Legado migrado {hoje:%Y-%m-%d %H%M}")
+            journal.limpar_copias(RESUMO_SHEET_NAME)
+            get_indice_lotes().invalidar(RESUMO_SHEET_NAME)
+        # 2. Compacta partições mensais antigas na aba anual correspondente
+        total_meses = hoje.year * 12 + hoje.month - 1 - ARQUIVO_MESES_ATIVOS
+        limite = f"{total_meses // 12:04d}-{total_meses % 12 + 1:02d}"
+        prefixo = f"{SHEET_NAME} "
+        for titulo in sorted(armazenamento.listar_abas()):
+            mes = titulo[len(prefixo):]
+            if not titulo.startswith(prefixo) or len(mes) != 7 or mes[4] != "-" or not mes.replace("-", "").isdigit():
+                continue
+            if mes >= limite:
+                continue
+            if not journal.copia_concluida(titulo, nome_arquivo(mes[:4])):
+                _, registros = armazenamento.ler_registros(titulo)
+                if registros:
+                    armazenamento.anexar(nome_arquivo(mes[:4]), registros, COLUNAS_PLANILHA)
+                journal.marcar_copia(titulo, nome_arquivo(mes[:4]))
+            armazenamento.apagar(titulo)
+            journal.limpar_copias(titulo)
+            resumo["particoes_arquivadas"].append(titulo)
+    listar_abas.clear()
+    expirar_snapshots()
+    load_backstock_data.clear()
+    load_resumo.clear()
+    return resumo
+
+# --- RESUMO MATERIALIZADO ---
+# A cada envio, o flusher acrescenta na aba de resumo as contagens do lote por
+# dia × usuário × categoria × bulto (e lote, para o reenvio ser idempotente).
+# Como a aba só recebe acréscimos, várias instâncias podem escrever ao mesmo
+# tempo; a leitura soma as linhas por chave.
+def agregar_resumo(registros):
+    contagem = {}
+    for registro in registros:
+        data = data_do_registro(registro["Data/Hora"])
+        if data is None:
+            get_metricas().contar("resumo_sem_data_total")  # sem dia, fora do resumo
+            continue
+        chave = (
+            data.strftime("%Y-%m-%d"),
+            str(registro["Usuário"]),
+            str(registro["Categoria"]),
+            str(registro["Bulto"]),
+            registro.get("Lote", ""),
+        )
+        contagem[chave] = contagem.get(chave, 0) + quantidade_do_registro(registro)
+    return [
+        {**dict(zip(CHAVE_RESUMO, chave[:4])), "Peças": pecas, "Lote": chave[4]}
+        for chave, pecas in contagem.items()
+    ]
+
+# O resumo também é particionado por mês ("Backstock Resumo 2025-07"): a
+# leitura só traz o mês consultado
+def nome_resumo(data):
+    return f"{RESUMO_SHEET_NAME} {data:%Y-%m}"
+
+def agrupar_resumo_por_mes(deltas):
+    grupos = {}
+    for delta in deltas:
+        grupos.setdefault(f"{RESUMO_SHEET_NAME} {str(delta['Dia'])[:7]}", []).append(delta)
+    return grupos
+
+def enviar_resumo_para_planilha(registros, verificar_lotes=False):
+    for nome_aba, deltas in agrupar_resumo_por_mes(agregar_resumo(registros)).items():
+        if verificar_lotes:
+            deltas = get_indice_lotes().sem_lotes_gravados(nome_aba, deltas)
+        if deltas:
+            get_armazenamento().anexar(nome_aba, deltas, COLUNAS_RESUMO)
+
+@st.cache_resource(ttl=120, show_spinner=False)
+def load_resumo(nome_aba, versao=None):
+    # Compartilhado entre sessões; quem usa não deve alterar o DataFrame
+    df = load_backstock_data(nome_aba, versao)
+    colunas = CHAVE_RESUMO + ["Peças"]
+    if df.empty or not set(colunas) <= set(df.columns):
+        return pd.DataFrame(columns=colunas)
+    df = df.loc[:, colunas].copy()
+    df["Peças"] = pd.to_numeric(df["Peças"], errors="coerce").fillna(0).astype(int)
+    return df.groupby(CHAVE_RESUMO, as_index=False, sort=False)["Peças"].sum()
+
+def resumo_cobre(resumo, data):
+    # O primeiro dia da aba pode estar incompleto (o resumo começou no meio
+    # dele); só os seguintes são confiáveis
+    return not resumo.empty and data.strftime("%Y-%m-%d") > resumo["Dia"].min()
+
+def filtrar_resumo(resumo, data, bulto, categoria, usuario):
+    mascara = (resumo["Dia"] == data.strftime("%Y-%m-%d")).to_numpy()
+    if bulto != "Todos":
+        mascara &= (resumo["Bulto"] == bulto).to_numpy()
+    if categoria != "Todas":
+        mascara &= (resumo["Categoria"] == categoria).to_numpy()
+    if usuario != "Todos":
+        mascara &= (resumo["Usuário"] == usuario).to_numpy()
+    return resumo[mascara]
+
+def estatisticas_do_resumo(resumo):
+    por = lambda col: resumo.groupby(col)["Peças"].sum().sort_values(ascending=False)
+    return {
+        "total": int(resumo["Peças"].sum()),
+        "bultos": resumo["Bulto"].nunique(),
+        "categorias": resumo["Categoria"].nunique(),
+        "usuarios": resumo["Usuário"].nunique(),
+        "por_bulto": por("Bulto"),
+        "por_categoria": por("Categoria"),
+        "por_usuario": por("Usuário"),
+    }
+
+def estatisticas_do_df(df):
+    return {
+        "total": int(df['Quantidade'].sum()),
+        "bultos": df['Bulto'].nunique(),
+        "categorias": df['Categoria'].nunique(),
+        "usuarios": df['Usuário'].nunique(),
+        "por_bulto": pecas_por(df, 'Bulto'),
+        "por_categoria": pecas_por(df, 'Categoria'),
+        "por_usuario": pecas_por(df, 'Usuário'),
+    }
+
+# --- MODELO TIPADO PARA A VISUALIZAÇÃO ---
+FORMATO_DATA_HORA = "%d/%m/%Y %H:%M:%S"   # mesmo formato gravado por hora_brasil()
+COLUNAS_CATEGORICAS = ["Usuário", "Categoria", "Bulto"]
+LINHAS_POR_PAGINA = 200   # linhas enviadas ao navegador por página da tabela
+
+def indice_de_posicoes(coluna):
+    # valor -> posições (em ordem crescente) das linhas com esse valor
+    codigos = coluna.cat.codes.to_numpy()
+    ordem = np.argsort(codigos, kind="stable")
+    limites = np.searchsorted(codigos[ordem], np.arange(len(coluna.cat.categories) + 1))
+    return {valor: ordem[limites[i]:limites[i + 1]] for i, valor in enumerate(coluna.cat.categories)}
+
+def preparar_modelo_backstock(df):
+    # Normaliza uma única vez por atualização do cache: tipos, datas e ordenação
+    df = df.copy()
+    for col in ["Bulto", "SKU"]:
+        if col in df.columns:
+            df[col] = df[col].astype(str)
+    if "Quantidade" in df.columns:
+        df["Quantidade"] = pd.to_numeric(df["Quantidade"], errors="coerce").fillna(1).clip(lower=1).astype(int)
+    else:
+        df["Quantidade"] = 1
+    if "Data/Hora" in df.columns:
+        df["Data/Hora"] = df["Data/Hora"].astype(str)
+        df = df[df["Data/Hora"].str.len() > 5]
+        data_hora = pd.to_datetime(df["Data/Hora"], format=FORMATO_DATA_HORA, errors="coerce")
+        faltando = data_hora.isna()
+        if faltando.any():
+            # Linhas antigas/manuais fora do formato padrão
+            data_hora[faltando] = pd.to_datetime(df.loc[faltando, "Data/Hora"], dayfirst=True, errors="coerce")
+        df["Data/Hora_dt"] = data_hora
+        df = df[~df["Data/Hora_dt"].isna()]
+        df = df.sort_values("Data/Hora_dt", ascending=False, kind="stable")
+    df = df.reset_index(drop=True)
+    opcoes = {}
+    indices = {}
+    for col in COLUNAS_CATEGORICAS:
+        if col in df.columns:
+            valores = df[col].dropna()
+            categorias = sorted(valores.unique())
+            df[col] = pd.Categorical(df[col], categories=categorias)
+            opcoes[col] = categorias
+            indices[col] = indice_de_posicoes(df[col])
+    # Data/Hora em ordem crescente para a busca binária do intervalo de um dia
+    ts = df["Data/Hora_dt"].to_numpy()[::-1] if "Data/Hora_dt" in df.columns else None
+    return {"df": df, "opcoes": opcoes, "indices": indices, "ts": ts}
+
+@st.cache_resource(ttl=120, show_spinner=False)
+def load_backstock_modelo(particoes, versoes=None, mes=None):
+    # Compartilhado entre sessões; quem usa não deve alterar o DataFrame. Com
+    # "mes" (primeiro dia do mês), só as linhas daquele mês são lidas
+    frames = [load_backstock_data(aba, versao, mes) for aba, versao in zip(particoes, versoes or [None] * len(particoes))]
+    frames = [f for f in frames if not f.empty]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return preparar_modelo_backstock(df)
+
+def intervalo_da_data(modelo, data, ate=None):
+    # df está em ordem decrescente de Data/Hora_dt: as linhas do dia (ou de
+    # data até "ate", exclusivo) são um intervalo contínuo de posições
+    n = len(modelo["df"])
+    if modelo["ts"] is None or data is None:
+        return 0, n
+    inicio = np.datetime64(pd.Timestamp(data))
+    fim = np.datetime64(pd.Timestamp(ate)) if ate else inicio + np.timedelta64(1, "D")
+    a, b = np.searchsorted(modelo["ts"], [inicio, fim])
+    return n - b, n - a
+
+def posicoes_filtradas(modelo, data, filtros, ate=None):
+    # Interseção do intervalo da data com as posições de cada valor escolhido
+    # (filtros: coluna -> valor); nenhuma máscara sobre o DataFrame inteiro
+    inicio, fim = intervalo_da_data(modelo, data, ate)
+    vazio = np.empty(0, dtype=np.intp)
+    listas = sorted((modelo["indices"].get(col, {}).get(valor, vazio) for col, valor in filtros.items()), key=len)
+    posicoes = None
+    for lista in listas:
+        lista = lista[np.searchsorted(lista, inicio):np.searchsorted(lista, fim)]
+        posicoes = lista if posicoes is None else np.intersect1d(posicoes, lista, assume_unique=True)
+    return np.arange(inicio, fim) if posicoes is None else posicoes
+
+def pecas_por(df, col):
+    # Soma das quantidades por valor da coluna (linhas antigas valem 1 peça)
+    soma = df.groupby(col, observed=True)["Quantidade"].sum()
+    return soma[soma > 0].sort_values(ascending=False)
+
+# --- EXPORTAÇÃO ---
+# As linhas filtradas saem em blocos direto das posições do modelo em cache, sem
+# montar uma cópia do recorte inteiro nem o texto inteiro de uma vez. O XLSX usa
+# o modo constant_memory do XlsxWriter, que grava cada linha assim que ela é
+# escrita. Limitação do Streamlit: st.download_button guarda o arquivo inteiro
+# em bytes no media manager, então o arquivo final fica em memória uma vez (por
+# isso é montado direto num BytesIO, devolvido ao botão sem cópia nossa).
+EXPORTACAO_BLOCO = 5000
+COLUNAS_EXPORTACAO = [col for col in COLUNAS_PLANILHA if col != "Lote"]
+
+def blocos_para_exportar(df, posicoes):
+    colunas = [col for col in COLUNAS_EXPORTACAO if col in df.columns]
+    for i in range(0, len(posicoes), EXPORTACAO_BLOCO):
+        yield df.iloc[posicoes[i:i + EXPORTACAO_BLOCO]][colunas]
+
+def exportar_csv(df, posicoes, arquivo):
+    texto = io.TextIOWrapper(arquivo, encoding="utf-8-sig", newline="")  # BOM para o Excel abrir com acentos
+    texto.write(",".join(col for col in COLUNAS_EXPORTACAO if col in df.columns) + "\n")
+    for bloco in blocos_para_exportar(df, posicoes):
+        bloco.to_csv(texto, header=False, index=False)
+    texto.flush()
+    texto.detach()
+
+def exportar_xlsx(df, posicoes, arquivo):
+    import xlsxwriter  # só quem exporta paga o import
+    workbook = xlsxwriter.Workbook(arquivo, {"constant_memory": True, "strings_to_urls": False})
+    planilha = workbook.add_worksheet("Backstock")
+    colunas = [col for col in COLUNAS_EXPORTACAO if col in df.columns]
+    planilha.write_row(0, 0, colunas, workbook.add_format({"bold": True}))
+    linha = 1
+    for bloco in blocos_para_exportar(df, posicoes):
+        for valores in bloco.itertuples(index=False, name=None):
+            planilha.write_row(linha, 0, valores)
+            linha += 1
+    workbook.close()
+
+def exportar(formato, df, posicoes):
+    with get_metricas().medir("exportacao_segundos", formato=formato):
+        arquivo = io.BytesIO()
+        gerar = exportar_xlsx if formato == "XLSX" else exportar_csv
+        gerar(df, posicoes, arquivo)
+        arquivo.seek(0)
+        return arquivo  # o download_button aceita o buffer direto
+
+# --- LOTES (ENVIO IDEMPOTENTE) ---
+# Cada bulto finalizado recebe um ID de lote gravado na coluna "Lote" de suas
+# linhas (e das linhas de resumo). Um append_rows é atômico por aba, então basta
+# saber se o lote já está na aba para decidir o reenvio. A conferência só é feita
+# depois de um envio com resultado incerto, e sempre relê a aba (tail-sync).
+def novo_id_lote():
+    return uuid.uuid4().hex
+
+class IndiceLotes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lotes = {}  # aba -> (IDs de lote já gravados, linhas vistas, última linha vista)
+
+    def lotes(self, nome_aba):
+        # Sempre relê a aba antes de responder: outro host pode ter gravado o
+        # lote. Na planilha a leitura só baixa a cauda (ver SincronizadorAba) e
+        # aqui só as linhas novas entram no conjunto; se o que já foi visto
+        # mudou (aba reescrita), o conjunto é refeito
         try:
-            sheet = spreadsheet.worksheet(SHEET_NAME)
-        except gspread.WorksheetNotFound:
-            sheet = spreadsheet.add_worksheet(title=SHEET_NAME, rows="1000", cols="20")
-            sheet.append_row(expected_columns)  # Cabeçalho
-        existing_rows = sheet.get_all_values()
-        if not existing_rows:
-            sheet.append_row(expected_columns)
-        rows = df_bulto.values.tolist()
-        if rows:
-            sheet.append_rows(rows)  # <- ENVIA TODAS AS LINHAS DE UMA VEZ
-        return True
+            df = get_armazenamento().ler(nome_aba)
+        except AbaNaoEncontrada:
+            df = pd.DataFrame()
+        with self._lock:
+            ids, vistas, ultima = self._lotes.get(nome_aba, (set(), 0, None))
+            if len(df) < vistas or (vistas and tuple(df.iloc[vistas - 1]) != ultima):
+                ids, vistas = set(), 0
+            if "Lote" in df.columns:
+                ids = ids | (set(df["Lote"].iloc[vistas:].astype(str)) - {""})
+            self._lotes[nome_aba] = (ids, len(df), tuple(df.iloc[-1]) if len(df) else None)
+            return ids
+
+    def sem_lotes_gravados(self, nome_aba, registros):
+        gravados = self.lotes(nome_aba)
+        novos = [r for r in registros if not r.get("Lote") or r["Lote"] not in gravados]
+        if len(novos) < len(registros):
+            get_metricas().contar("lotes_ignorados_total", len(registros) - len(novos), aba=nome_aba)
+        return novos
+
+    def invalidar(self, nome_aba):
+        with self._lock:
+            self._lotes.pop(nome_aba, None)
+
+@st.cache_resource
+def get_indice_lotes():
+    return IndiceLotes()
+
+def enviar_linhas_para_planilha(registros, verificar_lotes=False):
+    # Envio síncrono ao armazenamento; usado apenas pelo flusher em segundo plano
+    for nome_aba, grupo in agrupar_por_particao(registros).items():
+        if verificar_lotes:
+            grupo = get_indice_lotes().sem_lotes_gravados(nome_aba, grupo)
+            if not grupo:
+                continue
+        get_armazenamento().anexar(nome_aba, grupo, COLUNAS_PLANILHA)
+        if nome_aba not in listar_abas():
+            listar_abas.clear()  # partição nova
+
+def reconciliar_lotes(nome_aba, remover=False):
+    # Relatório das linhas gravadas mais de uma vez com o mesmo lote; com
+    # remover=True a aba é reescrita mantendo só a primeira ocorrência
+    armazenamento = get_armazenamento()
+    with get_journal().flush_lock:  # evita append do flusher no meio da reescrita
+        try:
+            cabecalho, registros = armazenamento.ler_registros(nome_aba)
+        except AbaNaoEncontrada:
+            return []
+        vistas = set()
+        mantidas = []
+        duplicadas = defaultdict(lambda: {"Bulto": "", "Linhas duplicadas": 0})
+        for registro in registros:
+            chave = tuple(registro.get(col, "") for col in cabecalho)
+            if registro.get("Lote") and chave in vistas:
+                duplicadas[registro["Lote"]]["Bulto"] = registro.get("Bulto", "")
+                duplicadas[registro["Lote"]]["Linhas duplicadas"] += 1
+                continue
+            vistas.add(chave)
+            mantidas.append(registro)
+        if remover and duplicadas:
+            armazenamento.reescrever(nome_aba, cabecalho, mantidas, registros)
+    return [{"Aba": nome_aba, "Lote": id_lote, **info} for id_lote, info in duplicadas.items()]
+
+def consolidar_quantidades(cadastros):
+    # Leituras repetidas do mesmo SKU no bulto viram uma linha com Quantidade
+    consolidados = {}
+    for cadastro in cadastros:
+        chave = (cadastro["Usuário"], cadastro["Bulto"], cadastro["SKU"], cadastro["Categoria"])
+        if chave in consolidados:
+            consolidados[chave]["Quantidade"] += quantidade_do_registro(cadastro)
+            consolidados[chave]["Data/Hora"] = cadastro["Data/Hora"]
+        else:
+            consolidados[chave] = {**cadastro, "Quantidade": quantidade_do_registro(cadastro)}
+    return list(consolidados.values())
+
+def compactar_quantidades(nome_aba):
+    # Migração: colapsa sequências de linhas idênticas em uma linha com Quantidade
+    armazenamento = get_armazenamento()
+    with get_journal().flush_lock:  # evita append do flusher no meio da reescrita
+        cabecalho, registros = armazenamento.ler_registros(nome_aba)
+        if not registros:
+            return 0
+        if "Quantidade" not in cabecalho:
+            cabecalho.append("Quantidade")
+        chaves = [col for col in cabecalho if col != "Quantidade"]
+        compactadas = []
+        anterior = None
+        for registro in registros:
+            chave = tuple(registro.get(col, "") for col in chaves)
+            # Linhas com lote já saem consolidadas; repetição delas é duplicidade (ver reconciliar_lotes)
+            if chave == anterior and not registro.get("Lote"):
+                compactadas[-1]["Quantidade"] += quantidade_do_registro(registro)
+            else:
+                compactadas.append({**registro, "Quantidade": quantidade_do_registro(registro)})
+                anterior = chave
+        removidas = len(registros) - len(compactadas)
+        if removidas > 0:
+            armazenamento.reescrever(nome_aba, cabecalho, compactadas, registros)
+    return removidas
+
+# --- JOURNAL LOCAL (WRITE-BEHIND) ---
+# Cada bulto finalizado é gravado primeiro em um SQLite local (WAL) e só depois
+# enviado à planilha por uma thread em segundo plano, em lotes e com retentativas.
+# O journal é único no processo: bultos de todas as sessões que chegam na mesma
+# janela saem juntos em um append_rows por partição. Réplicas no mesmo diretório
+# dividem o arquivo; a trava de flush vale entre processos, então só um flusher
+# envia por vez e cada bulto sai uma única vez.
+JOURNAL_PATH = "backstock_journal.db"
+FLUSH_INTERVALO = 2.0      # segundos entre verificações do journal
+FLUSH_JANELA = 0.5         # espera após um registro para juntar bultos de outras sessões
+FLUSH_MAX_BULTOS = 50      # bultos agrupados por append_rows
+FLUSH_BACKOFF_MAX = 60.0   # espera máxima entre retentativas
+JOURNAL_RETENCAO_DIAS = 30          # bultos enviados (linhas e resumo) ficam este tempo no journal
+JOURNAL_LIMPEZA_INTERVALO = 3600.0  # segundos entre limpezas do journal
+
+class TravaEntreProcessos:
+    # threading.Lock para as threads do processo + flock para os demais processos
+    def __init__(self, caminho):
+        self._lock = threading.Lock()
+        self._caminho = caminho
+        self._arquivo = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self._arquivo = open(self._caminho, "w")
+            if fcntl is not None:
+                fcntl.flock(self._arquivo, fcntl.LOCK_EX)
+        except BaseException:
+            if self._arquivo is not None:
+                self._arquivo.close()
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._arquivo.close()  # fechar o arquivo solta o flock
+        finally:
+            self._arquivo = None
+            self._lock.release()
+
+class JournalBultos:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS bultos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                linhas TEXT NOT NULL,
+                criado_em REAL NOT NULL,
+                enviado_em REAL,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                ultimo_erro TEXT
+            )
+        """)
+        colunas = {row[1] for row in self._conn.execute("PRAGMA table_info(bultos)")}
+        if "resumo_enviado_em" not in colunas:
+            self._conn.execute("ALTER TABLE bultos ADD COLUMN resumo_enviado_em REAL")
+        if "lote" not in colunas:
+            self._conn.execute("ALTER TABLE bultos ADD COLUMN lote TEXT")
+        if "tentativas_resumo" not in colunas:
+            self._conn.execute("ALTER TABLE bultos ADD COLUMN tentativas_resumo INTEGER NOT NULL DEFAULT 0")
+            # Pendentes de antes da coluna: não se sabe se já houve tentativa
+            self._conn.execute(
+                "UPDATE bultos SET tentativas_resumo = 1 WHERE enviado_em IS NOT NULL AND resumo_enviado_em IS NULL"
+            )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_bultos_lote ON bultos (lote)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_bultos_pendentes ON bultos (enviado_em, id)")
+        # Parcial: só os bultos ainda fora do resumo, que são poucos
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_bultos_pendentes_resumo ON bultos (id) WHERE resumo_enviado_em IS NULL"
+        )
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS copias_concluidas (
+                origem TEXT NOT NULL,
+                destino TEXT NOT NULL,
+                PRIMARY KEY (origem, destino)
+            )
+        """)
+        self.novo_registro = threading.Event()
+        self.flush_lock = TravaEntreProcessos(f"{path}.lock")
+        self._acks = {}  # id -> Future resolvido quando o bulto chega à planilha
+        self.iniciado_em = time.time()
+
+    @staticmethod
+    def _carregar(linhas):
+        # Entradas antigas guardavam listas na ordem de COLUNAS_LEGADAS
+        return [r if isinstance(r, dict) else dict(zip(COLUNAS_LEGADAS, r)) for r in json.loads(linhas)]
+
+    def registrar(self, registros, id_lote):
+        # Um lote já registrado (finalização repetida) não entra de novo: devolve
+        # o ack do registro existente
+        with self._lock:
+            existente = self._conn.execute("SELECT id, enviado_em FROM bultos WHERE lote = ?", (id_lote,)).fetchone()
+            if existente is not None:
+                id_, enviado_em = existente
+                if id_ in self._acks:
+                    return self._acks[id_]
+                ack = Future()
+                if enviado_em is not None:
+                    ack.set_result(enviado_em)
+                else:
+                    self._acks[id_] = ack
+                return ack
+            cur = self._conn.execute(
+                "INSERT INTO bultos (linhas, criado_em, lote) VALUES (?, ?, ?)",
+                (json.dumps(registros, ensure_ascii=False), time.time(), id_lote)
+            )
+            ack = Future()
+            self._acks[cur.lastrowid] = ack
+        self.novo_registro.set()
+        return ack
+
+    def pendentes(self, limite=FLUSH_MAX_BULTOS):
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT id, linhas FROM bultos WHERE enviado_em IS NULL ORDER BY id LIMIT ?",
+                (limite,)
+            )
+            return [(id_, self._carregar(linhas)) for id_, linhas in cur.fetchall()]
+
+    def marcar_enviados(self, ids):
+        agora = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE bultos SET enviado_em = ?, ultimo_erro = NULL WHERE id = ?",
+                [(agora, id_) for id_ in ids]
+            )
+            acks = [self._acks.pop(id_) for id_ in ids if id_ in self._acks]
+        for ack in acks:
+            ack.set_result(agora)
+
+    def pendentes_resumo(self, limite=FLUSH_MAX_BULTOS):
+        # Bultos já gravados na partição cujo delta ainda não foi para o resumo
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT id, linhas FROM bultos WHERE enviado_em IS NOT NULL AND resumo_enviado_em IS NULL "
+                "ORDER BY id LIMIT ?",
+                (limite,)
+            )
+            return [(id_, self._carregar(linhas)) for id_, linhas in cur.fetchall()]
+
+    def marcar_resumo_enviado(self, ids):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE bultos SET resumo_enviado_em = ? WHERE id = ?",
+                [(time.time(), id_) for id_ in ids]
+            )
+
+    def iniciar_envio(self, ids):
+        # Conta a tentativa antes do envio e diz se o lote precisa ser conferido
+        # na planilha: já houve tentativa (deste ou de outro processo, que pode
+        # ter caído no meio) ou o bulto é de antes deste processo subir
+        with self._lock:
+            marcadores = ",".join("?" * len(ids))
+            incerto = self._conn.execute(
+                f"SELECT COUNT(*) FROM bultos WHERE id IN ({marcadores}) AND (tentativas > 0 OR criado_em < ?)",
+                (*ids, self.iniciado_em)
+            ).fetchone()[0] > 0
+            self._conn.execute(f"UPDATE bultos SET tentativas = tentativas + 1 WHERE id IN ({marcadores})", ids)
+            return incerto
+
+    def iniciar_envio_resumo(self, ids):
+        # Como iniciar_envio, para o delta do resumo: a contagem fica no banco,
+        # então vale também para a tentativa de um processo que caiu no meio
+        with self._lock:
+            marcadores = ",".join("?" * len(ids))
+            incerto = self._conn.execute(
+                f"SELECT COUNT(*) FROM bultos WHERE id IN ({marcadores}) AND tentativas_resumo > 0", ids
+            ).fetchone()[0] > 0
+            self._conn.execute(f"UPDATE bultos SET tentativas_resumo = tentativas_resumo + 1 WHERE id IN ({marcadores})", ids)
+            return incerto
+
+    def marcar_falha(self, ids, erro):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE bultos SET ultimo_erro = ? WHERE id = ?",
+                [(str(erro), id_) for id_ in ids]
+            )
+
+    def resolver_acks(self):
+        # Bultos desta sessão enviados pelo flusher de outro processo
+        with self._lock:
+            ids = list(self._acks)
+            if not ids:
+                return
+            marcadores = ",".join("?" * len(ids))
+            enviados = self._conn.execute(
+                f"SELECT id, enviado_em FROM bultos WHERE id IN ({marcadores}) AND enviado_em IS NOT NULL", ids
+            ).fetchall()
+            acks = [(self._acks.pop(id_), enviado_em) for id_, enviado_em in enviados]
+        for ack, enviado_em in acks:
+            ack.set_result(enviado_em)
+
+    # Progresso de arquivar_particoes: cópias de aba já feitas
+    def copia_concluida(self, origem, destino):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM copias_concluidas WHERE origem = ? AND destino = ?", (origem, destino)
+            ).fetchone() is not None
+
+    def marcar_copia(self, origem, destino):
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO copias_concluidas (origem, destino) VALUES (?, ?)", (origem, destino))
+
+    def limpar_copias(self, origem):
+        with self._lock:
+            self._conn.execute("DELETE FROM copias_concluidas WHERE origem = ?", (origem,))
+
+    def limpar_enviados(self, antes_de):
+        # Retenção: bultos já na planilha e no resumo antes de "antes_de" saem do journal
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM bultos WHERE enviado_em < ? AND resumo_enviado_em < ?", (antes_de, antes_de)
+            ).rowcount
+
+    def status(self):
+        with self._lock:
+            pendentes, enviados = self._conn.execute(
+                "SELECT COUNT(*) FILTER (WHERE enviado_em IS NULL), "
+                "COUNT(*) FILTER (WHERE enviado_em IS NOT NULL) FROM bultos"
+            ).fetchone()
+            ultimo_erro = self._conn.execute(
+                "SELECT ultimo_erro FROM bultos WHERE enviado_em IS NULL AND ultimo_erro IS NOT NULL "
+                "ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            ultimo_envio = self._conn.execute("SELECT MAX(enviado_em) FROM bultos").fetchone()
+        return {
+            "pendentes": pendentes,
+            "enviados": enviados,
+            "ultimo_erro": ultimo_erro[0] if ultimo_erro else None,
+            "ultimo_envio": ultimo_envio[0],
+        }
+
+def flush_journal(journal):
+    with journal.flush_lock:
+        return _flush_journal(journal)
+
+def _flush_journal(journal):
+    lote = journal.pendentes()
+    if lote:
+        ids = [id_ for id_, _ in lote]
+        registros = [r for _, linhas in lote for r in linhas]
+        try:
+            enviar_linhas_para_planilha(registros, verificar_lotes=journal.iniciar_envio(ids))
+        except Exception as e:
+            journal.marcar_falha(ids, e)
+            raise
+        journal.marcar_enviados(ids)
+    lote_resumo = journal.pendentes_resumo()
+    if lote_resumo:
+        ids = [id_ for id_, _ in lote_resumo]
+        enviar_resumo_para_planilha(
+            [r for _, linhas in lote_resumo for r in linhas],
+            verificar_lotes=journal.iniciar_envio_resumo(ids)
+        )
+        journal.marcar_resumo_enviado(ids)
+    return max(len(lote), len(lote_resumo))
+
+def _loop_flusher(journal):
+    espera = FLUSH_INTERVALO
+    ultima_limpeza = 0.0
+    while True:
+        if espera > FLUSH_INTERVALO:
+            time.sleep(espera)  # em backoff, bultos novos não antecipam a retentativa
+        elif journal.novo_registro.wait(timeout=espera):
+            time.sleep(FLUSH_JANELA)
+        journal.novo_registro.clear()
+        try:
+            while flush_journal(journal) == FLUSH_MAX_BULTOS:
+                pass
+            espera = FLUSH_INTERVALO
+        except Exception as e:
+            espera = min(max(espera, FLUSH_INTERVALO) * 2, FLUSH_BACKOFF_MAX)
+            if eh_cota_excedida(e):
+                espera = max(espera, pausa_cota_excedida(e))
+        journal.resolver_acks()
+        if time.time() - ultima_limpeza > JOURNAL_LIMPEZA_INTERVALO:
+            ultima_limpeza = time.time()
+            try:
+                removidos = journal.limpar_enviados(ultima_limpeza - JOURNAL_RETENCAO_DIAS * 86400)
+                get_metricas().contar("journal_removidos_total", removidos)
+            except Exception:
+                pass  # tenta de novo no próximo intervalo
+
+@st.cache_resource
+def get_journal():
+    journal = JournalBultos(JOURNAL_PATH)
+    threading.Thread(target=_loop_flusher, args=(journal,), name="flusher-backstock", daemon=True).start()
+    return journal
+
+def salvar_bulto_na_planilha(df_bulto, id_lote):
+    # Garante que só as colunas corretas vão para a planilha; devolve um Future
+    # resolvido quando o bulto chega à planilha (None se nem o journal gravou)
+    if "Quantidade" not in df_bulto.columns:
+        df_bulto = df_bulto.assign(Quantidade=1)
+    df_bulto = df_bulto.assign(Lote=id_lote)  # o mesmo ID acompanha o bulto em todas as tentativas
+    df_bulto = df_bulto.loc[:, COLUNAS_PLANILHA]
+    try:
+        registros = df_bulto.to_dict("records")
+        for registro in registros:
+            registro["Quantidade"] = int(registro["Quantidade"])
+        return get_journal().registrar(registros, id_lote)  # <- o envio à planilha ocorre em segundo plano
     except Exception as e:
-        st.error(f"Erro ao salvar na planilha: {e}")
-        return False
+        st.error(f"Erro ao registrar bulto no journal local: {e}")
+        return None
 
 def hora_brasil():
     fuso_brasil = pytz.timezone('America/Sao_Paulo')
     return datetime.now(fuso_brasil).strftime("%d/%m/%Y %H:%M:%S")
 
-def validar_usuario(codigo):
-    try:
-        url = "https://docs.google.com/spreadsheets/d/e/2PACX-1vQT66XECK150fz-NTRkNAEtlmt1sjSnfCHScgYB812JXd7UHs2JadldU5jOnQaZG3MDA95eJdgH5PZE/pub?output=csv"
-        response = requests.get(url)
+# --- DIRETÓRIO DE USUÁRIOS (CACHE + REVALIDAÇÃO EM SEGUNDO PLANO) ---
+USUARIOS_CSV_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vQT66XECK150fz-NTRkNAEtlmt1sjSnfCHScgYB812JXd7UHs2JadldU5jOnQaZG3MDA95eJdgH5PZE/pub?output=csv"
+USUARIOS_TTL = 300          # segundos até o diretório ser considerado velho
+USUARIOS_TTL_MISS = 30      # código não encontrado força revalidação após este intervalo
+USUARIOS_TIMEOUT = 10       # timeout (s) do download do CSV
+
+class CsvPublicado:
+    # CSV publicado (Google Sheets "publicar na web") mantido em memória no
+    # processo; subclasses definem _indexar(df) e a consulta
+    nome = "csv"
+
+    def __init__(self, url):
+        self.url = url
+        self._session = montar_pool_http(requests.Session())
+        self._lock = threading.Lock()
+        self._dados = None          # resultado de _indexar
+        self._etag = None
+        self._last_modified = None
+        self._atualizado_em = 0.0
+        self._atualizando = False
+        self._carregado = threading.Event()
+        self.ultimo_erro = None
+
+    def _indexar(self, df):
+        raise NotImplementedError
+
+    def _baixar(self):
+        headers = {}
+        if self._dados is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        inicio = time.perf_counter()
+        try:
+            response = self._session.get(self.url, headers=headers, timeout=USUARIOS_TIMEOUT)
+        finally:
+            get_metricas().observar("requests_chamada_segundos", time.perf_counter() - inicio, operacao=self.nome)
+        get_metricas().contar("requests_chamadas_total", operacao=self.nome, status=response.status_code)
+        if response.status_code == 304:
+            self._atualizado_em = time.time()
+            return
+        response.raise_for_status()
         response.encoding = 'utf-8'
-        csv_data = StringIO(response.text)
-        df = pd.read_csv(csv_data)
+        dados = self._indexar(pd.read_csv(StringIO(response.text), dtype=str, keep_default_na=False))
+        with self._lock:
+            self._dados = dados
+            self._etag = response.headers.get("ETag")
+            self._last_modified = response.headers.get("Last-Modified")
+            self._atualizado_em = time.time()
+            self.ultimo_erro = None
+        self._carregado.set()
+
+    def _revalidar(self):
+        try:
+            self._baixar()
+        except Exception as e:
+            self.ultimo_erro = e   # mantém o diretório anterior
+        finally:
+            with self._lock:
+                self._atualizando = False
+
+    def revalidar_em_segundo_plano(self):
+        with self._lock:
+            if self._atualizando:
+                return
+            self._atualizando = True
+        threading.Thread(target=self._revalidar, name=f"revalida-{self.nome}", daemon=True).start()
+
+    def aquecer(self):
+        if self._dados is None:
+            self.revalidar_em_segundo_plano()
+
+class DiretorioUsuarios(CsvPublicado):
+    nome = "usuarios_csv"
+
+    @staticmethod
+    def normalizar(codigo):
+        return str(codigo).strip().lower()
+
+    def _indexar(self, df):
         if 'Criptografia' not in df.columns or 'Usuário' not in df.columns:
-            st.error("Estrutura da planilha inválida. Verifique as colunas.")
-            return None
-        df['Criptografia'] = df['Criptografia'].astype(str).str.strip().str.lower()
-        codigo = str(codigo).strip().lower()
-        if codigo in df['Criptografia'].values:
-            return df.loc[df['Criptografia'] == codigo, 'Usuário'].values[0]
-        return None
+            raise ValueError("Estrutura da planilha inválida. Verifique as colunas.")
+        usuarios = {}  # código normalizado -> nome do usuário
+        for codigo, nome in zip(df['Criptografia'], df['Usuário']):
+            usuarios.setdefault(self.normalizar(codigo), nome)  # primeira ocorrência vence
+        return usuarios
+
+    def buscar(self, codigo):
+        if self._dados is None:
+            # Aproveita a carga já disparada pela tela de login, se houver
+            if self._atualizando:
+                self._carregado.wait(timeout=USUARIOS_TIMEOUT)
+            if self._dados is None:
+                self._baixar()  # primeira carga precisa bloquear
+        idade = time.time() - self._atualizado_em
+        nome = self._dados.get(self.normalizar(codigo))
+        if idade > USUARIOS_TTL or (nome is None and idade > USUARIOS_TTL_MISS):
+            self.revalidar_em_segundo_plano()
+        return nome
+
+@st.cache_resource
+def get_diretorio_usuarios():
+    # [usuarios] csv_url em secrets.toml permite apontar para outra fonte (ex.: benchmark)
+    return DiretorioUsuarios(ler_secao_secrets("usuarios").get("csv_url", USUARIOS_CSV_URL))
+
+def validar_usuario(codigo):
+    try:
+        return get_diretorio_usuarios().buscar(codigo)
     except Exception as e:
         st.error(f"Erro ao validar usuário: {str(e)}")
         return None
 
-if "cadastros" not in st.session_state:
-    st.session_state["cadastros"] = []
+# --- CATÁLOGO DE SKUS ---
+# Conjunto de SKUs válidos carregado uma vez por processo de um CSV publicado,
+# como o diretório de usuários. A consulta nunca bloqueia a leitura: enquanto o
+# catálogo não chegou, o SKU é aceito sem verificação. Configurado em
+# secrets.toml, seção [catalogo]: csv_url (obrigatório para ativar) e coluna.
+CATALOGO_TTL = 900          # segundos até o catálogo ser revalidado em segundo plano
+CATALOGO_RETRY = 30         # intervalo mínimo (s) entre downloads após falha ou SKU ausente
+
+class CatalogoSkus(CsvPublicado):
+    nome = "catalogo_csv"
+
+    def __init__(self, url, coluna="SKU"):
+        super().__init__(url)
+        self.coluna = coluna
+        self._tentou_em = 0.0
+
+    @staticmethod
+    def normalizar(sku):
+        return str(sku).strip()
+
+    def _indexar(self, df):
+        if self.coluna not in df.columns:
+            raise ValueError(f"Coluna '{self.coluna}' não encontrada no catálogo de SKUs.")
+        return frozenset(self.normalizar(sku) for sku in df[self.coluna] if sku)
+
+    def contem(self, sku):
+        # True/False, ou None se o catálogo ainda não foi carregado. Um SKU
+        # ausente também revalida o catálogo (pode ter sido cadastrado agora),
+        # como USUARIOS_TTL_MISS no diretório de usuários
+        agora = time.time()
+        presente = None if self._dados is None else self.normalizar(sku) in self._dados
+        ttl = CATALOGO_TTL if presente else CATALOGO_RETRY
+        if (presente is None or agora - self._atualizado_em > ttl) and agora - self._tentou_em > CATALOGO_RETRY:
+            self._tentou_em = agora
+            self.revalidar_em_segundo_plano()
+        return presente
+
+@st.cache_resource
+def get_catalogo_skus():
+    config = ler_secao_secrets("catalogo")
+    if not config.get("csv_url"):
+        return None
+    return CatalogoSkus(config["csv_url"], config.get("coluna", "SKU"))
+
+# --- AQUECIMENTO EM SEGUNDO PLANO ---
+# Na primeira execução do processo, uma thread importa os módulos pesados, gera
+# o token da conta de serviço e abre a planilha (TLS + OAuth), baixa o diretório
+# de usuários e sobe o journal. As telas esperam pelo evento "pronto" em vez de
+# pausas fixas.
+AQUECIMENTO_TIMEOUT = 15    # espera máxima (s) da tela inicial pelo aquecimento
+
+class Aquecimento:
+    def __init__(self):
+        self.pronto = threading.Event()
+        self.erros = {}
+        threading.Thread(target=self._aquecer, name="aquecimento-backstock", daemon=True).start()
+
+    def _etapa(self, nome, funcao):
+        try:
+            with get_metricas().medir("aquecimento_segundos", etapa=nome):
+                funcao()
+        except Exception as e:
+            self.erros[nome] = e  # a etapa é refeita sob demanda no primeiro uso
+
+    def _aquecer(self):
+        self._etapa("imports", lambda: [importlib.import_module(m) for m in ("pandas", "numpy", "gspread", "pyarrow")])
+        self._etapa("usuarios", get_diretorio_usuarios().aquecer)
+        if get_catalogo_skus() is not None:
+            self._etapa("catalogo", get_catalogo_skus().aquecer)
+        if ler_secao_secrets("storage").get("backend", "sheets") == "sheets":
+            self._etapa("planilha", get_google_sheet)
+        self._etapa("journal", get_journal)
+        self.pronto.set()
+
+@st.cache_resource
+def get_aquecimento():
+    return Aquecimento()
+
+# --- FOCO DO CAMPO DE LEITURA ---
+# Componente único (st.components.v2, sem iframe) que recebe a key do campo
+# ativo e um marcador de estado. O foco só é movido quando esse par muda; o
+# campo é achado pela classe estável "st-key-<key>" que o Streamlit põe no
+# contêiner do widget, sem observar o DOM.
+JS_FOCO = """
+export default function(component) {
+    const { data } = component;
+    const alvo = `${data.campo}|${data.marcador}`;
+    if (window.__backstockFoco === alvo) return;
+    window.__backstockFoco = alvo;
+    let tentativas = 10;  // o campo pode ainda não estar no DOM neste quadro
+    const focar = () => {
+        const input = document.querySelector(`.st-key-${data.campo} input`);
+        if (!input) {
+            if (--tentativas > 0) requestAnimationFrame(focar);
+            return;
+        }
+        input.focus();
+        input.classList.add("focused-input");
+        input.addEventListener("blur", () => input.classList.remove("focused-input"), { once: true });
+    };
+    requestAnimationFrame(focar);
+}
+"""
+
+def get_componente_foco():
+    # Registrado a cada execução (é idempotente): o registro pertence ao Runtime,
+    # e um cache_resource o deixaria preso ao primeiro Runtime do processo
+    return st.components.v2.component("foco_campo", js=JS_FOCO)
+
+def focar_campo(campo, marcador=""):
+    get_componente_foco()(key="foco_campo", data={"campo": campo, "marcador": str(marcador)}, height=0)
+
+# --- LEITOR EM RAJADA ---
+# Para leitores rápidos e leituras em lote: os SKUs ficam num buffer no
+# navegador e seguem ao servidor como um único evento quando o leitor pausa
+# (RAJADA_OCIOSO_MS), o buffer enche (RAJADA_MAXIMO) ou o campo perde o foco
+# (toque em outro botão) ou é desmontado. O servidor registra o
+# lote inteiro numa passada e o fragmento é refeito uma vez por lote, não por bipe.
+RAJADA_OCIOSO_MS = 300      # pausa do leitor (ms) que fecha um lote
+RAJADA_MAXIMO = 100         # SKUs por lote; um lote cheio é enviado na hora
+
+JS_RAJADA = """
+export default function(component) {
+    const { data, parentElement, setTriggerValue } = component;
+    let input = parentElement.querySelector("input");
+    if (!input) {
+        input = document.createElement("input");
+        input.placeholder = "Bipe os SKUs em sequência...";
+        const fila = document.createElement("div");
+        fila.className = "fila";
+        parentElement.append(input, fila);
+        const estado = { buffer: [], timer: null, seq: 0, setTriggerValue };
+        estado.enviar = () => {
+            clearTimeout(estado.timer);
+            if (!estado.buffer.length) return;
+            estado.setTriggerValue("lote", { id: `${Date.now()}-${++estado.seq}`, skus: estado.buffer });
+            estado.buffer = [];
+            fila.textContent = "";
+        };
+        input.addEventListener("keydown", (e) => {
+            if (e.key !== "Enter" && e.key !== "Tab") return;
+            e.preventDefault();
+            const sku = input.value.trim();
+            input.value = "";
+            if (!sku) return;
+            estado.buffer.push(sku);
+            fila.textContent = `${estado.buffer.length} na fila`;
+            clearTimeout(estado.timer);
+            if (estado.buffer.length >= data.maximo) estado.enviar();
+            else estado.timer = setTimeout(estado.enviar, data.ocioso_ms);
+        });
+        // Tocar em "Finalizar Bulto" ou no modo rajada tira o foco antes do
+        // clique: o que estiver na fila sai antes da ação do botão
+        input.addEventListener("blur", () => estado.enviar());
+        parentElement.rajada = estado;
+    }
+    const estado = parentElement.rajada;
+    estado.setTriggerValue = setTriggerValue;
+    input.focus();
+    return () => estado.enviar();  // desmontagem: não descarta a fila
+}
+"""
+
+CSS_RAJADA = """
+input {
+    width: 100%;
+    box-sizing: border-box;
+    font-size: 24px;
+    padding: 10px;
+    border: 2px solid var(--st-primary-color);
+    border-radius: 8px;
+}
+.fila {
+    min-height: 1.5em;
+    color: gray;
+}
+"""
+
+def get_leitor_rajada():
+    # Registrado a cada execução, como o componente de foco
+    return st.components.v2.component("leitor_rajada", js=JS_RAJADA, css=CSS_RAJADA)
+
+def leitor_rajada():
+    get_leitor_rajada()(
+        key="leitor_rajada",
+        data={"ocioso_ms": RAJADA_OCIOSO_MS, "maximo": RAJADA_MAXIMO},
+        on_lote_change=registrar_rajada
+    )
+
+# --- MÁQUINA DE ESTADOS DO CADASTRO ---
+# bulto -> categoria -> sku | quantidade -> finalizando -> bulto
+CATEGORIA_TARA_MAIOR = "Tara maior - sem SKU Interno"
+SKU_TARA_MAIOR = "3000000000000"
+TRANSICOES = {
+    "bulto": {"categoria"},
+    "categoria": {"sku", "quantidade"},
+    "sku": {"categoria", "finalizando"},
+    "quantidade": {"categoria", "finalizando"},
+    "finalizando": {"bulto"},
+}
+
+def transicao(nova_etapa, ignorar_invalida=False):
+    atual = st.session_state.etapa
+    if nova_etapa not in TRANSICOES[atual]:
+        if ignorar_invalida:
+            # Callback atrasado de um botão de outra etapa (ex.: duplo toque em Finalizar)
+            get_metricas().contar("transicoes_ignoradas_total", de=atual, para=nova_etapa)
+            return False
+        raise ValueError(f"Transição inválida: {atual} -> {nova_etapa}")
+    if nova_etapa == "finalizando":
+        # Criado uma vez por bulto: uma execução de "finalizando" interrompida e
+        # repetida reenvia o mesmo lote, que o journal reconhece
+        st.session_state["lote_bulto"] = novo_id_lote()
+    st.session_state.etapa = nova_etapa
+    st.session_state["transicoes"] = st.session_state.get("transicoes", 0) + 1  # marcador do foco
+    return True
+
+def reiniciar_cadastro():
+    st.session_state.etapa = "bulto"
+    st.session_state["transicoes"] = st.session_state.get("transicoes", 0) + 1
+    st.session_state["pecas_bulto"] = 0
+    st.session_state.pop("quantidade_tara_maior", None)
+    st.session_state.pop("qtd_input", None)
+    st.session_state.pop("lote_bulto", None)
+
+def leituras_do_bulto(bulto):
+    # Livro da sessão por bulto: contagem por SKU (detecção de repetição em O(1))
+    # e as leituras na ordem em que foram bipadas
+    return st.session_state["leituras_por_bulto"].setdefault(bulto, {"contagem": {}, "leituras": []})
+
+def todas_as_leituras():
+    return [l for livro in st.session_state["leituras_por_bulto"].values() for l in livro["leituras"]]
+
+def registrar_leituras(skus):
+    # Registra um ou vários SKUs numa passada: valida no catálogo, conta no
+    # livro do bulto e atualiza "Peças cadastradas" uma vez no fim
+    catalogo = get_catalogo_skus()
+    livro = leituras_do_bulto(st.session_state["bulto_numero"])
+    resultados = []
+    for sku in skus:
+        if catalogo is not None and catalogo.contem(sku) is False:
+            resultados.append({"sku": sku, "status": "desconhecido"})
+            continue
+        vezes = livro["contagem"].get(sku, 0) + 1
+        livro["contagem"][sku] = vezes
+        livro["leituras"].append({
+            "Usuário": st.session_state["user_name"],
+            "Bulto": st.session_state["bulto_numero"],
+            "SKU": sku,
+            "Categoria": st.session_state["categoria_selecionada"],
+            "Data/Hora": hora_brasil()
+        })
+        resultados.append({"sku": sku, "status": "repetido" if vezes > 1 else "ok", "vezes": vezes})
+    st.session_state["pecas_bulto"] = len(livro["leituras"])
+    st.session_state["ultimas_leituras"] = resultados
+    for status in ("ok", "repetido", "desconhecido"):
+        n = sum(1 for r in resultados if r["status"] == status)
+        if n:
+            get_metricas().contar("leituras_sku_total", n, status=status)
+
+def registrar_leitura_sku():
+    # Callback do campo de SKU: roda antes do fragmento ser redesenhado
+    sku = st.session_state.get("sku_input", "").strip()
+    if not sku:
+        return
+    st.session_state["sku_input"] = ""
+    registrar_leituras([sku])
+
+def registrar_rajada():
+    # Callback do leitor em rajada; o id descarta um lote reenviado
+    lote = st.session_state["leitor_rajada"].get("lote") or {}
+    if not lote.get("skus") or lote.get("id") == st.session_state.get("ultimo_lote_rajada"):
+        return
+    st.session_state["ultimo_lote_rajada"] = lote.get("id")
+    skus = [str(sku).strip() for sku in lote["skus"] if str(sku).strip()]
+    get_metricas().contar("rajadas_total")
+    registrar_leituras(skus)
+
+def desfazer_ultima_leitura():
+    # Para bipe duplo: remove a última leitura do bulto atual
+    livro = leituras_do_bulto(st.session_state["bulto_numero"])
+    if livro["leituras"]:
+        sku = livro["leituras"].pop()["SKU"]
+        livro["contagem"][sku] -= 1
+        if not livro["contagem"][sku]:
+            del livro["contagem"][sku]
+        st.session_state["pecas_bulto"] = len(livro["leituras"])
+    st.session_state["ultimas_leituras"] = []
+
+def trocar_modo_leitura():
+    # Novo marcador para o foco voltar ao campo de SKU ao sair do modo rajada
+    st.session_state["transicoes"] = st.session_state.get("transicoes", 0) + 1
+
+def mostrar_ultimas_leituras():
+    resultados = st.session_state.get("ultimas_leituras")
+    if not resultados:
+        return
+    if len(resultados) == 1:
+        leitura = resultados[0]
+        if leitura["status"] == "desconhecido":
+            st.error(f"❌ SKU '{leitura['sku']}' não consta no catálogo. Peça não cadastrada, confira o código e bipe novamente.")
+        elif leitura["status"] == "repetido":
+            st.warning(f"⚠️ SKU '{leitura['sku']}' já foi lido {leitura['vezes']} vezes neste bulto.")
+            st.button("↩️ Desfazer última leitura", key="desfazer_leitura", on_click=desfazer_ultima_leitura)
+        else:
+            st.success(f"Peça '{leitura['sku']}' cadastrada com sucesso!")
+        return
+    cadastradas = sum(1 for r in resultados if r["status"] != "desconhecido")
+    desconhecidos = [r["sku"] for r in resultados if r["status"] == "desconhecido"]
+    repetidos = sorted({r["sku"] for r in resultados if r["status"] == "repetido"})
+    if cadastradas:
+        st.success(f"{cadastradas} peças cadastradas neste lote!")
+    if desconhecidos:
+        st.error(f"❌ {len(desconhecidos)} SKUs fora do catálogo não foram cadastrados: {', '.join(desconhecidos)}")
+    if repetidos:
+        st.warning(f"⚠️ SKUs lidos mais de uma vez neste bulto: {', '.join(repetidos)}")
+
+@st.fragment
+def leitura_de_skus():
+    # Só este trecho roda a cada bipe (ou lote); o resto da página não é refeito
+    with get_metricas().medir("fragmento_segundos", etapa="sku"):
+        st.markdown(f"<div class='big-font'>Peças cadastradas: {st.session_state.get('pecas_bulto', 0)}</div>", unsafe_allow_html=True)
+        modo_rajada = st.toggle("Modo rajada (leitor rápido / lote)", key="modo_rajada", on_change=trocar_modo_leitura)
+        if modo_rajada:
+            leitor_rajada()
+        else:
+            st.text_input(
+                "SKU",
+                key="sku_input",
+                placeholder="Bipe o SKU e pressione Enter...",
+                label_visibility="collapsed",
+                on_change=registrar_leitura_sku
+            )
+            focar_campo("sku_input", f"{st.session_state.get('transicoes', 0)}:{st.session_state.get('pecas_bulto', 0)}")
+        mostrar_ultimas_leituras()
+
+def finalizar_bulto_tara_maior():
+    if transicao("finalizando", ignorar_invalida=True):
+        st.session_state["quantidade_tara_maior"] = st.session_state.get("qtd_input")
+
+# --- TEMPO DE CADA RERUN ---
+# st.rerun()/st.stop() interrompem o script com exceção, então toda saída
+# antecipada passa por rerun()/parar() para registrar a duração da execução.
+def marcar_etapa(etapa):
+    st.session_state["_rerun_etapa"] = etapa
+
+def fim_do_rerun():
+    inicio = st.session_state.pop("_rerun_inicio", None)
+    if inicio is not None:
+        get_metricas().observar("rerun_segundos", time.perf_counter() - inicio, etapa=st.session_state.get("_rerun_etapa", "?"))
+
+def rerun():
+    fim_do_rerun()
+    st.rerun()
+
+def parar():
+    fim_do_rerun()
+    st.stop()
+
+st.session_state["_rerun_inicio"] = time.perf_counter()
+get_metricas().contar("reruns_total")
+marcar_etapa("inicio")
+aquecimento = get_aquecimento()
+
+if "leituras_por_bulto" not in st.session_state:
+    st.session_state["leituras_por_bulto"] = {}  # ver leituras_do_bulto
 if "etapa" not in st.session_state:
-    st.session_state.etapa = "bulto"  # bulto -> categoria -> sku
+    st.session_state.etapa = "bulto"  # ver TRANSICOES
 
 st.set_page_config(layout="wide")
 
@@ -156,56 +2327,27 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-def auto_focus_input(placeholder_text="Digite seu código de acesso..."):
-    components.html(f"""
-    <script>
-    function focusUserInput() {{
-        setTimeout(() => {{
-            const inputs = Array.from(window.parent.document.querySelectorAll('input[type="text"]'));
-            const targetInput = inputs.find(input => 
-                input.value === "" && 
-                (input.placeholder.includes("{placeholder_text}") || 
-                 input.placeholder.includes("Bipe o SKU") ||
-                 input.placeholder.includes("número do bulto"))
-            );
-            if (targetInput) {{
-                targetInput.classList.add('focused-input');
-                targetInput.focus();
-                targetInput.addEventListener('blur', () => {{
-                    targetInput.classList.remove('focused-input');
-                }});
-            }}
-        }}, 100);
-    }}
-    focusUserInput();
-    const observer = new MutationObserver(focusUserInput);
-    observer.observe(window.parent.document.body, {{
-        childList: true,
-        subtree: true
-    }});
-    </script>
-    """, height=0)
-
 if "inicio" not in st.session_state:
     st.session_state["inicio"] = False      
 
 if not st.session_state["inicio"]:
     st.title("SISTEMA DE CONTROLE DE BACKSTOCK")
     if st.button("Iniciar"):
-        with st.spinner("Carregando o sistema..."):
-            time.sleep(2)
-        st.success("Sistema carregado com sucesso! Vamos para a tela de usuário.")
-        time.sleep(1)
+        if not aquecimento.pronto.is_set():
+            with st.spinner("Carregando o sistema..."):
+                aquecimento.pronto.wait(timeout=AQUECIMENTO_TIMEOUT)
+        st.toast("Sistema carregado com sucesso! Vamos para a tela de usuário.", icon="✅")
         st.session_state["inicio"] = True
-        st.rerun()
+        rerun()
     st.image("https://f.hellowork.com/media/123957/1440_960/IDLOGISTICSFRANCE_123957_63809226079153822430064462.jpeg", use_container_width=True)
-    st.stop()
+    parar()
 
 if "user_code" not in st.session_state or not st.session_state["user_code"]:
     st.session_state["user_code"] = ""
     st.session_state["user_name"] = ""
 
 if not st.session_state["user_code"]:
+    marcar_etapa("login")
     st.title("Cadastro Obrigatório para continuar o acesso")
     codigo_usuario = st.text_input(
         "Código de acesso", 
@@ -213,51 +2355,41 @@ if not st.session_state["user_code"]:
         placeholder="Digite seu código de acesso...",
         label_visibility="collapsed"
     )
-    auto_focus_input("Digite seu código de acesso...")
+    focar_campo("user_input")
+    get_diretorio_usuarios().aquecer()  # adianta o download enquanto o operador digita
     if codigo_usuario.strip():
         with st.spinner("Validando código..."):
             nome_usuario = validar_usuario(codigo_usuario.strip())
         if nome_usuario:
             st.session_state["user_code"] = codigo_usuario.strip()
             st.session_state["user_name"] = nome_usuario
-            st.success(f"Usuário validado: {nome_usuario}")
-            time.sleep(1)
-            st.rerun()
+            st.toast(f"Usuário validado: {nome_usuario}", icon="✅")
+            rerun()
         else:
             st.error("❌ Código de acesso inválido. Por favor, tente novamente.")
     else:
         st.warning("Por favor, digite um código de acesso válido.")
     st.image("https://f.hellowork.com/media/123957/1440_960/IDLOGISTICSFRANCE_123957_63809226079153822430064462.jpeg", use_container_width=True)
-    st.stop()
+    parar()
 
 selecao = option_menu(
     menu_title="BACKSTOCK",
-    options=["Cadastro Bulto", "Tabela", "Visualizar Planilha", "Sair"],
-    icons=["box", "table", "eye", "house"],
+    options=["Cadastro Bulto", "Tabela", "Visualizar Planilha", "Métricas", "Sair"],
+    icons=["box", "table", "eye", "speedometer2", "house"],
     menu_icon="cast",
     orientation="horizontal"
 )
 
+marcar_etapa(st.session_state.etapa if selecao == "Cadastro Bulto" else selecao)
+
 if selecao == "Sair":
     st.session_state["inicio"] = False
     st.session_state["user_code"] = ""
     st.session_state["user_name"] = ""
-    st.session_state["bulto_cadastrado"] = False
-    st.session_state.etapa = "bulto"
-    st.session_state["finalizar_bulto_disabled"] = False
-    st.session_state["finalizar_bulto_aguardando"] = False
-    st.rerun()
+    reiniciar_cadastro()
+    rerun()
 
 if selecao == "Cadastro Bulto":
-    if (
-        "finalizar_bulto_disabled" not in st.session_state
-        or st.session_state.get("reset_finalizar_bulto", False)
-    ):
-        st.session_state["finalizar_bulto_disabled"] = False
-        st.session_state["reset_finalizar_bulto"] = False
-    if "finalizar_bulto_aguardando" not in st.session_state:
-        st.session_state["finalizar_bulto_aguardando"] = False
-
     if st.session_state.etapa == "bulto":
         st.markdown("<h1 style='color:black; text-align: center;'>Cadastro de Bultos</h1>", unsafe_allow_html=True)
         st.markdown("<h2 style='color:black; text-align: center;'>Digite o número do bulto</h2>", unsafe_allow_html=True)
@@ -267,14 +2399,14 @@ if selecao == "Cadastro Bulto":
             placeholder="Digite o número do bulto...",
             label_visibility="collapsed"
         )
-        auto_focus_input()
+        focar_campo("bulto_input", st.session_state.get("transicoes", 0))
         if bulto:
             st.session_state["bulto_numero"] = bulto
-            st.session_state["bulto_cadastrado"] = True
-            st.session_state.etapa = "categoria"
-            st.session_state["peca_reset_count"] = 0
-            st.session_state["reset_finalizar_bulto"] = True
-            st.rerun()
+            # Um bulto reaberto na mesma sessão continua de onde parou
+            st.session_state["pecas_bulto"] = len(leituras_do_bulto(bulto)["leituras"])
+            st.session_state.pop("ultimas_leituras", None)
+            transicao("categoria")
+            rerun()
     elif st.session_state.etapa == "categoria":
         st.markdown("<h1 style='color:black; text-align: center;'>Selecione a Categoria</h1>", unsafe_allow_html=True)
         st.markdown(f"<div class='big-font'>Bulto: {st.session_state['bulto_numero']}</div>", unsafe_allow_html=True)
@@ -282,7 +2414,7 @@ if selecao == "Cadastro Bulto":
             "Ubicação",
             "Reetiquetagem",
             "Tara maior - Não recuperável",
-            "Tara maior - sem SKU Interno",
+            CATEGORIA_TARA_MAIOR,
             "Costura",
             "Limpeza"
         ]
@@ -293,12 +2425,8 @@ if selecao == "Cadastro Bulto":
                 if st.button(categoria, key=f"cat_{categoria}", use_container_width=True):
                     st.session_state["categoria_selecionada"] = categoria
                     # Se for a categoria especial, pula para etapa especial
-                    if categoria == "Tara maior - sem SKU Interno":
-                        st.session_state.etapa = "quantidade"
-                    else:
-                        st.session_state.etapa = "sku"
-                    st.session_state["reset_finalizar_bulto"] = True
-                    st.rerun()
+                    transicao("quantidade" if categoria == CATEGORIA_TARA_MAIOR else "sku")
+                    rerun()
     elif st.session_state.etapa == "sku":
         st.markdown("<h1 style='color:black; text-align: center;'>Cadastro de Peças</h1>", unsafe_allow_html=True)
         col1, col2, col3 = st.columns(3)
@@ -308,74 +2436,22 @@ if selecao == "Cadastro Bulto":
             st.markdown(f"<div class='big-font'>Bulto: {st.session_state['bulto_numero']}</div>", unsafe_allow_html=True)
         with col3:
             st.markdown(f"<div class='big-font'>Categoria: {st.session_state['categoria_selecionada']}</div>", unsafe_allow_html=True)
-        st.markdown(f"<div class='big-font'>Peças cadastradas: {st.session_state.get('peca_reset_count', 0)}</div>", unsafe_allow_html=True)
         if st.button("↩️ Mudar Categoria", key="mudar_categoria", use_container_width=True, type="secondary"):
-            st.session_state.etapa = "categoria"
-            st.rerun()
-        unique_key = f"sku_input_{st.session_state.get('peca_reset_count', 0)}"
-        sku = st.text_input(
-            "SKU", 
-            key=unique_key, 
-            placeholder="Bipe o SKU e pressione Enter...",
-            label_visibility="collapsed"
-        )
-        auto_focus_input()
-        if sku:
-            novo_cadastro = {
-                "Usuário": st.session_state["user_name"],
-                "Bulto": st.session_state["bulto_numero"],
-                "SKU": sku,
-                "Categoria": st.session_state["categoria_selecionada"],
-                "Data/Hora": hora_brasil()
-            }
-            st.session_state["cadastros"].append(novo_cadastro)
-            st.success(f"Peça '{sku}' cadastrada com sucesso!")
-            st.session_state["peca_reset_count"] = st.session_state.get("peca_reset_count", 0) + 1
-            st.rerun()
-
-        def bloquear_finalizar_bulto():
-            st.session_state["finalizar_bulto_disabled"] = True
-            st.session_state["finalizar_bulto_aguardando"] = True
-
+            transicao("categoria")
+            rerun()
+        leitura_de_skus()
         st.button(
             "✅ Finalizar Bulto",
             key="finalizar_bulto",
             use_container_width=True,
             type="primary",
-            disabled=st.session_state["finalizar_bulto_disabled"],
-            on_click=bloquear_finalizar_bulto
+            on_click=transicao,
+            args=("finalizando",),
+            kwargs={"ignorar_invalida": True}
         )
-
-        if st.session_state.get("finalizar_bulto_aguardando", False):
-            st.markdown('<div class="enviando-msg-idlog">Finalizando Bulto...<br>Por favor, aguarde!</div>', unsafe_allow_html=True)
-            with st.spinner("Salvando bulto na planilha, aguarde..."):
-                time.sleep(0.7)
-                if st.session_state.get("peca_reset_count", 0) > 0:
-                    bulto_atual = st.session_state["bulto_numero"]
-                    df_cadastros = pd.DataFrame([c for c in st.session_state["cadastros"] if c["Bulto"] == bulto_atual])
-                    expected_columns = ["Usuário", "Bulto", "SKU", "Categoria", "Data/Hora"]
-                    if "Quantidade" in df_cadastros.columns:
-                        expected_columns.insert(4, "Quantidade")
-                    df_cadastros = df_cadastros.loc[:, expected_columns]
-                    if not df_cadastros.empty:
-                        sucesso = salvar_bulto_na_planilha(df_cadastros)
-                        if sucesso:
-                            st.success("✅ Bulto finalizado e salvo na planilha com sucesso!")
-                            st.session_state["cadastros"] = []
-                        else:
-                            st.error("❌ Erro ao salvar o bulto na planilha.")
-                    else:
-                        st.warning("⚠️ Nenhuma peça cadastrada neste bulto para envio.")
-                else:
-                    st.warning("⚠️ Nenhuma peça cadastrada neste bulto.")
-                st.session_state["bulto_cadastrado"] = False
-                st.session_state["peca_reset_count"] = 0
-                st.session_state.etapa = "bulto"
-                st.session_state["finalizar_bulto_aguardando"] = False
-            st.rerun()
     elif st.session_state.etapa == "quantidade":
         # Só para a categoria "Tara maior - sem SKU Interno"
-        if st.session_state.get("categoria_selecionada", "") == "Tara maior - sem SKU Interno":
+        if st.session_state.get("categoria_selecionada", "") == CATEGORIA_TARA_MAIOR:
             st.markdown("<h1 style='color:black; text-align: center;'>Cadastro de Peças - Tara maior sem SKU Interno</h1>", unsafe_allow_html=True)
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -384,147 +2460,293 @@ if selecao == "Cadastro Bulto":
                 st.markdown(f"<div class='big-font'>Bulto: {st.session_state['bulto_numero']}</div>", unsafe_allow_html=True)
             with col3:
                 st.markdown(f"<div class='big-font'>Categoria: {st.session_state['categoria_selecionada']}</div>", unsafe_allow_html=True)
-            st.markdown(f"<div class='big-font'>Peças cadastradas: {st.session_state.get('peca_reset_count', 0)}</div>", unsafe_allow_html=True)
+            st.markdown(f"<div class='big-font'>Peças cadastradas: {st.session_state.get('pecas_bulto', 0)}</div>", unsafe_allow_html=True)
             if st.button("↩️ Mudar Categoria", key="mudar_categoria_qtd", use_container_width=True, type="secondary"):
-                st.session_state.etapa = "categoria"
-                st.rerun()
-            unique_key = f"qtd_input_{st.session_state.get('peca_reset_count', 0)}"
-            quantidade = st.number_input(
+                transicao("categoria")
+                rerun()
+            st.number_input(
                 "Quantidade de peças",
                 min_value=1,
                 step=1,
-                key=unique_key,
+                key="qtd_input",
                 placeholder="Digite a quantidade de peças...",
             )
-            auto_focus_input("Digite a quantidade de peças...")
-
-            def bloquear_finalizar_bulto_tara_maior():
-                st.session_state["finalizar_bulto_disabled"] = True
-                st.session_state["finalizar_bulto_aguardando_3000000000000"] = True
-
+            focar_campo("qtd_input", st.session_state.get("transicoes", 0))
             st.button(
                 "✅ Finalizar Bulto",
                 key="finalizar_bulto_sku_3000000000000",
                 use_container_width=True,
                 type="primary",
-                disabled=st.session_state.get("finalizar_bulto_disabled", False),
-                on_click=bloquear_finalizar_bulto_tara_maior
+                on_click=finalizar_bulto_tara_maior
             )
-
-            # Fluxo para finalizar bulto com SKU '3000000000000' (quantidade de linhas igual ao digitado)
-            if st.session_state.get("finalizar_bulto_aguardando_3000000000000", False):
-                st.markdown('<div class="enviando-msg-idlog">Finalizando Bulto...<br>Por favor, aguarde!</div>', unsafe_allow_html=True)
-                with st.spinner("Salvando bulto na planilha, aguarde..."):
-                    time.sleep(0.7)
-                    if quantidade and quantidade > 0:
-                        bulto_atual = st.session_state["bulto_numero"]
-                        data_hora = hora_brasil()
-                        linhas = []
-                        for i in range(int(quantidade)):
-                            cadastro_3000000000000 = {
-                                "Usuário": st.session_state["user_name"],
-                                "Bulto": bulto_atual,
-                                "SKU": "3000000000000",
-                                "Categoria": st.session_state["categoria_selecionada"],
-                                "Data/Hora": data_hora
-                            }
-                            linhas.append(cadastro_3000000000000)
-                        df_cadastros = pd.DataFrame(linhas)
-                        expected_columns = ["Usuário", "Bulto", "SKU", "Categoria", "Data/Hora"]
-                        df_cadastros = df_cadastros.loc[:, expected_columns]
-                        sucesso = salvar_bulto_na_planilha(df_cadastros)
-                        if sucesso:
-                            st.success(f"✅ Bulto finalizado e salvo na planilha com {quantidade} linhas (SKU 3000000000000)!")
-                            st.success(f"✅ Bulto finalizado e salvo na planilha com {quantidade} peças!")
-                            st.session_state["cadastros"] = []
-                        else:
-                            st.error("❌ Erro ao salvar o bulto na planilha.")
-                    else:
-                        st.warning("⚠️ Nenhuma quantidade informada para envio.")
-                    st.session_state["bulto_cadastrado"] = False
-                    st.session_state["peca_reset_count"] = 0
-                    st.session_state.etapa = "bulto"
-                    st.session_state["finalizar_bulto_aguardando_3000000000000"] = False
-                    st.session_state["finalizar_bulto_disabled"] = False
-                st.rerun()
         else:
             # Caso no futuro outras categorias usem essa etapa,
             # pode seguir o fluxo padrão (se houver).
             st.markdown("Categoria inválida para etapa de quantidade.", unsafe_allow_html=True)
             if st.button("↩️ Voltar", key="voltar_quantidade_erro"):
-                st.session_state.etapa = "categoria"
-                st.rerun()
+                transicao("categoria")
+                rerun()
+    elif st.session_state.etapa == "finalizando":
+        # O botão some junto com a etapa anterior; um segundo toque que chegue
+        # depois é ignorado por transicao()
+        st.markdown('<div class="enviando-msg-idlog">Finalizando Bulto...<br>Por favor, aguarde!</div>', unsafe_allow_html=True)
+        with st.spinner("Registrando bulto, aguarde..."):
+            bulto_atual = st.session_state["bulto_numero"]
+            registros = consolidar_quantidades(leituras_do_bulto(bulto_atual)["leituras"])
+            # Fluxo "Tara maior - sem SKU Interno": uma linha com a quantidade digitada
+            quantidade = st.session_state.get("quantidade_tara_maior")
+            if quantidade and quantidade > 0:
+                registros.append({
+                    "Usuário": st.session_state["user_name"],
+                    "Bulto": bulto_atual,
+                    "SKU": SKU_TARA_MAIOR,
+                    "Categoria": CATEGORIA_TARA_MAIOR,
+                    "Quantidade": int(quantidade),
+                    "Data/Hora": hora_brasil()
+                })
+            if registros:
+                id_lote = st.session_state.setdefault("lote_bulto", novo_id_lote())
+                ack = salvar_bulto_na_planilha(pd.DataFrame(registros), id_lote)
+                if ack is not None:
+                    st.session_state.setdefault("envios", {})[bulto_atual] = ack
+                    pecas = sum(quantidade_do_registro(r) for r in registros)
+                    st.success(f"✅ Bulto finalizado e registrado com {pecas} peças! O envio à planilha ocorre em segundo plano.")
+                    st.session_state["leituras_por_bulto"].pop(bulto_atual, None)
+                else:
+                    st.error("❌ Erro ao salvar o bulto na planilha.")
+            else:
+                st.warning("⚠️ Nenhuma peça cadastrada neste bulto.")
+            reiniciar_cadastro()
+        rerun()
 
 elif selecao == "Tabela":
     st.markdown("<h1 style='color:black; text-align: center;'>Tabela de Peças Cadastradas</h1>", unsafe_allow_html=True)
-    if st.session_state["cadastros"]:
-        df_cadastros = pd.DataFrame(st.session_state["cadastros"])
+    cadastros = todas_as_leituras()
+    if cadastros:
+        df_cadastros = pd.DataFrame(cadastros)
         st.dataframe(df_cadastros, use_container_width=True)
         if st.button("🧹 Limpar todos os registros", type="secondary", use_container_width=True):
-            st.session_state["cadastros"] = []
+            st.session_state["leituras_por_bulto"] = {}
             st.success("Todos os registros foram limpos!")
-            st.rerun()
+            rerun()
     else:
         st.info("Nenhuma peça cadastrada até o momento.")
+    st.subheader("🔁 Sincronização com a planilha")
+    status_journal = get_journal().status()
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Bultos pendentes de envio", status_journal["pendentes"])
+    with col2:
+        st.metric("Bultos enviados", status_journal["enviados"])
+    if status_journal["ultimo_envio"]:
+        st.caption(f"Último envio: {datetime.fromtimestamp(status_journal['ultimo_envio'], pytz.timezone('America/Sao_Paulo')).strftime('%d/%m/%Y %H:%M:%S')}")
+    if status_journal["ultimo_erro"]:
+        st.warning(f"Última falha de envio (nova tentativa automática): {status_journal['ultimo_erro']}")
+    envios = st.session_state.get("envios", {})
+    if envios:
+        fuso = pytz.timezone('America/Sao_Paulo')
+        st.dataframe(pd.DataFrame([
+            {"Bulto": bulto, "Planilha": "✅ " + datetime.fromtimestamp(ack.result(), fuso).strftime('%H:%M:%S') if ack.done() else "⏳ pendente"}
+            for bulto, ack in reversed(list(envios.items()))
+        ]), width="stretch", hide_index=True)
 
 elif selecao == "Visualizar Planilha":
     st.header("📋 Visualização dos Registros da Planilha Backstock")
     if st.button("🔄 Atualizar Dados da Planilha"):
+        expirar_snapshots()
         load_backstock_data.clear()
+        load_backstock_modelo.clear()
+        load_resumo.clear()
+        listar_abas.clear()
         st.toast("Dados da planilha atualizados!", icon="🔄")
-    df = load_backstock_data()
+    st.subheader("Filtros")
+    col1, col2, col3, col4 = st.columns(4)
+    with col4:
+        data_filtro = st.date_input("Data:", datetime.now()) or datetime.now().date()
+    # Só as partições do mês escolhido são lidas
+    particoes = particoes_para_data(data_filtro)
+    modelo = load_backstock_modelo(particoes, versoes_das_abas(particoes), data_filtro.replace(day=1))
+    df = modelo["df"]
     if not df.empty:
-        for col in ["Bulto", "SKU"]:
-            if col in df.columns:
-                df[col] = df[col].astype(str)
-        if "Data/Hora" in df.columns:
-            df["Data/Hora"] = df["Data/Hora"].astype(str)
-            df = df[df["Data/Hora"].str.len() > 5]
-            df["Data/Hora_dt"] = pd.to_datetime(df["Data/Hora"], dayfirst=True, errors="coerce")
-            df = df[~df["Data/Hora_dt"].isna()]
-            df = df.sort_values("Data/Hora_dt", ascending=False)
-            df = df.drop(columns=["Data/Hora_dt"])
-        st.subheader("Filtros")
-        col1, col2, col3, col4 = st.columns(4)
+        opcoes = modelo["opcoes"]
         with col1:
-            setor_filtro = st.selectbox("Bulto:", ["Todos"] + sorted(df['Bulto'].dropna().unique()))
+            setor_filtro = st.selectbox("Bulto:", ["Todos"] + opcoes.get('Bulto', []))
         with col2:
-            categoria_filtro = st.selectbox("Categoria:", ["Todas"] + sorted(df['Categoria'].dropna().unique()))
+            categoria_filtro = st.selectbox("Categoria:", ["Todas"] + opcoes.get('Categoria', []))
         with col3:
-            usuario_filtro = st.selectbox("Usuário:", ["Todos"] + sorted(df['Usuário'].dropna().unique()))
-        with col4:
-            data_filtro = st.date_input("Data:", datetime.now())
-        if setor_filtro != "Todos":
-            df = df[df['Bulto'] == setor_filtro]
-        if categoria_filtro != "Todas":
-            df = df[df['Categoria'] == categoria_filtro]
-        if usuario_filtro != "Todos":
-            df = df[df['Usuário'] == usuario_filtro]
-        if data_filtro:
-            df = df[pd.to_datetime(df['Data/Hora'], dayfirst=True, errors="coerce").dt.date == data_filtro]
-        st.dataframe(df, use_container_width=True)
+            usuario_filtro = st.selectbox("Usuário:", ["Todos"] + opcoes.get('Usuário', []))
+        filtros = {
+            col: valor for col, valor, todos in [
+                ("Bulto", setor_filtro, "Todos"),
+                ("Categoria", categoria_filtro, "Todas"),
+                ("Usuário", usuario_filtro, "Todos"),
+            ] if valor != todos
+        }
+        posicoes = posicoes_filtradas(modelo, data_filtro, filtros)
+        # Só a página visível vai para o navegador
+        total_paginas = max(1, -(-len(posicoes) // LINHAS_POR_PAGINA))
+        col_pagina, col_linhas = st.columns([1, 3])
+        with col_pagina:
+            pagina = st.number_input("Página", min_value=1, max_value=total_paginas, value=1, step=1)
+        inicio_pagina = (pagina - 1) * LINHAS_POR_PAGINA
+        pagina_df = df.iloc[posicoes[inicio_pagina:inicio_pagina + LINHAS_POR_PAGINA]]
+        with col_linhas:
+            if len(posicoes):
+                st.caption(f"Linhas {inicio_pagina + 1}–{inicio_pagina + len(pagina_df)} de {len(posicoes)} · página {pagina} de {total_paginas}")
+            else:
+                st.caption("Nenhuma linha com os filtros escolhidos.")
+        st.dataframe(pagina_df.drop(columns=["Data/Hora_dt", "Lote"], errors="ignore"), width="stretch")
+        col_formato, col_periodo, col_baixar = st.columns(3)
+        with col_formato:
+            formato_exportacao = st.radio("Formato:", ["CSV", "XLSX"], horizontal=True, key="formato_exportacao")
+        with col_periodo:
+            mes_inteiro = st.checkbox("Exportar o mês inteiro", key="exportar_mes")
+        if mes_inteiro:
+            inicio_mes = data_filtro.replace(day=1)
+            fim_mes = (inicio_mes + timedelta(days=32)).replace(day=1)
+            posicoes_exportacao = posicoes_filtradas(modelo, inicio_mes, filtros, ate=fim_mes)
+            nome_exportacao = f"backstock_{inicio_mes:%Y-%m}"
+        else:
+            posicoes_exportacao = posicoes
+            nome_exportacao = f"backstock_{data_filtro:%Y-%m-%d}"
+        with col_baixar:
+            # O arquivo só é gerado no clique (em outra thread), não a cada rerun
+            st.download_button(
+                f"⬇️ Exportar {len(posicoes_exportacao)} linhas",
+                data=lambda formato=formato_exportacao, df=df, posicoes=posicoes_exportacao: exportar(formato, df, posicoes),
+                file_name=f"{nome_exportacao}.{formato_exportacao.lower()}",
+                mime="text/csv" if formato_exportacao == "CSV" else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key="exportar_filtrados",
+                disabled=not len(posicoes_exportacao),
+            )
         st.subheader("📊 Estatísticas")
+        aba_resumo = nome_resumo(data_filtro)
+        resumo = load_resumo(aba_resumo, versoes_das_abas([aba_resumo]))
+        if resumo_cobre(resumo, data_filtro):
+            stats = estatisticas_do_resumo(filtrar_resumo(resumo, data_filtro, setor_filtro, categoria_filtro, usuario_filtro))
+        else:
+            # Dia anterior ao resumo: soma as linhas filtradas
+            stats = estatisticas_do_df(df.iloc[posicoes][["Bulto", "Categoria", "Usuário", "Quantidade"]])
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Total de Registros", len(df))
+            st.metric("Total de Peças", stats["total"])
         with col2:
-            st.metric("Bultos Diferentes", df['Bulto'].nunique())
+            st.metric("Bultos Diferentes", stats["bultos"])
         with col3:
-            st.metric("Categorias", df['Categoria'].nunique())
+            st.metric("Categorias", stats["categorias"])
         with col4:
-            st.metric("Usuários", df['Usuário'].nunique())
+            st.metric("Usuários", stats["usuarios"])
         tab1, tab2, tab3 = st.tabs(["Bultos", "Categorias", "Usuários"])
         with tab1:
-            st.bar_chart(df['Bulto'].value_counts())
+            st.bar_chart(stats["por_bulto"])
         with tab2:
-            st.bar_chart(df['Categoria'].value_counts())
+            st.bar_chart(stats["por_categoria"])
         with tab3:
-            st.bar_chart(df['Usuário'].value_counts().head(5))
+            st.bar_chart(stats["por_usuario"].head(5))
     else:
         st.info("Nenhum registro encontrado na planilha.")
+    with st.expander("🗄️ Manutenção das partições"):
+        if admin_autorizado():
+            acao = st.session_state.pop("acao_manutencao", None)
+            st.caption(
+                f"Migra a aba legada '{SHEET_NAME}' para as partições mensais e compacta "
+                f"meses com mais de {ARQUIVO_MESES_ATIVOS} meses em abas anuais."
+            )
+            confirmado = st.checkbox("Confirmo que quero arquivar as partições", key="confirmar_arquivar")
+            st.button("Arquivar partições antigas", key="arquivar_particoes",
+                      disabled=not confirmado, on_click=pedir_manutencao, args=("arquivar",))
+            if acao == "arquivar":
+                with st.spinner("Arquivando partições..."):
+                    try:
+                        resumo = arquivar_particoes()
+                        load_backstock_modelo.clear()
+                        st.success(
+                            f"{resumo['linhas_migradas']} linhas migradas da aba legada; "
+                            f"{len(resumo['particoes_arquivadas'])} partições arquivadas."
+                        )
+                        if resumo["linhas_sem_data"]:
+                            st.warning(
+                                f"{resumo['linhas_sem_data']} linhas sem Data/Hora válida foram para a aba "
+                                f"'{SEM_DATA_SHEET_NAME}' para correção manual."
+                            )
+                    except Exception as e:
+                        st.error(f"Erro ao arquivar partições: {e}")
+            st.caption("Colapsa sequências de linhas idênticas das abas do mês selecionado em uma linha com Quantidade.")
+            confirmado = st.checkbox("Confirmo que quero reescrever as abas do mês", key="confirmar_compactar")
+            st.button("Compactar linhas repetidas", key="compactar_quantidades",
+                      disabled=not confirmado, on_click=pedir_manutencao, args=("compactar",))
+            if acao == "compactar":
+                with st.spinner("Compactando linhas..."):
+                    try:
+                        removidas = sum(compactar_quantidades(aba) for aba in particoes_para_data(data_filtro))
+                        expirar_snapshots()
+                        load_backstock_data.clear()
+                        load_backstock_modelo.clear()
+                        st.success(f"{removidas} linhas repetidas compactadas.")
+                    except Exception as e:
+                        st.error(f"Erro ao compactar linhas: {e}")
+            st.caption("Procura lotes (bultos) gravados mais de uma vez nas abas do mês selecionado e no resumo.")
+            col_verificar, col_remover = st.columns(2)
+            with col_verificar:
+                verificar = st.button("Verificar lotes duplicados", key="verificar_lotes")
+            with col_remover:
+                confirmado = st.checkbox("Confirmo que quero apagar as linhas duplicadas", key="confirmar_remover_lotes")
+                st.button("Remover lotes duplicados", key="remover_lotes",
+                          disabled=not confirmado, on_click=pedir_manutencao, args=("remover_lotes",))
+            remover = acao == "remover_lotes"
+            if verificar or remover:
+                with st.spinner("Conferindo lotes..."):
+                    try:
+                        abas = particoes_para_data(data_filtro) + (nome_resumo(data_filtro),)
+                        relatorio = [linha for aba in abas for linha in reconciliar_lotes(aba, remover=remover)]
+                        if remover:
+                            expirar_snapshots()
+                            load_backstock_data.clear()
+                            load_backstock_modelo.clear()
+                            load_resumo.clear()
+                        if relatorio:
+                            acao = "removidas" if remover else "encontradas"
+                            st.warning(f"{sum(r['Linhas duplicadas'] for r in relatorio)} linhas duplicadas {acao} em {len(relatorio)} lotes.")
+                            st.dataframe(pd.DataFrame(relatorio), width="stretch", hide_index=True)
+                        else:
+                            st.success("Nenhum lote duplicado.")
+                    except Exception as e:
+                        st.error(f"Erro ao conferir lotes: {e}")
+
+elif selecao == "Métricas":
+    st.header("⏱️ Métricas de Desempenho")
+    metricas = get_metricas()
+    st.subheader("Cota do Google Sheets (últimos 60 s)")
+    uso = metricas.uso_cota()
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("Leituras", f"{uso['leitura']} / {COTA_LEITURA_POR_MINUTO}")
+        st.progress(min(uso["leitura"] / COTA_LEITURA_POR_MINUTO, 1.0))
+    with col2:
+        st.metric("Escritas", f"{uso['escrita']} / {COTA_ESCRITA_POR_MINUTO}")
+        st.progress(min(uso["escrita"] / COTA_ESCRITA_POR_MINUTO, 1.0))
+    st.subheader("Tempos (reruns, etapas, Sheets e CSV de usuários)")
+    duracoes = metricas.tabela_duracoes()
+    if not duracoes.empty:
+        st.dataframe(duracoes.sort_values(["métrica", "labels"]), width="stretch", hide_index=True)
+    st.subheader("Caches")
+    taxas = metricas.taxas_cache()
+    if not taxas.empty:
+        st.dataframe(taxas, width="stretch", hide_index=True)
+    st.subheader("Contadores")
+    contadores = metricas.tabela_contadores()
+    if not contadores.empty:
+        st.dataframe(contadores.sort_values(["métrica", "labels"]), width="stretch", hide_index=True)
+    st.caption(f"Coletando desde {datetime.fromtimestamp(metricas.iniciado_em, pytz.timezone('America/Sao_Paulo')).strftime('%d/%m/%Y %H:%M:%S')}")
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("⬇️ Exportar JSON lines", metricas.json_linhas(), file_name="backstock_metricas.jsonl", mime="application/x-ndjson", width="stretch")
+    with col2:
+        st.download_button("⬇️ Exportar Prometheus", metricas.prometheus(), file_name="backstock_metricas.prom", mime="text/plain", width="stretch")
 
 st.markdown("""
     <div class="footer">
         Copyright © 2025 Direitos Autorais Desenvolvedores Rogério Ferreira e Kauê Oliveira
     </div>
 """, unsafe_allow_html=True)
+fim_do_rerun()